@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+"""datagen.py
+
+Seeded synthetic data for the benchmark suite. generate() writes
+conferences (with seat shards, speaker rosters, histograms and the
+announcement), sessions, speakers and profiles with registrations and
+wishlists straight through ndb, in batches, into whatever datastore is
+active (the testbed stub in run.py), and returns a manifest of sampled
+keys for the benchmarks to pick their inputs from. The same seed and
+scale always produce the same data.
+
+Entities get string ids so later allocate_ids calls made by the app
+can't collide with them. A few sessions and profiles are written in
+their pre-migration shape (string speaker key, legacy lists) so the
+migration paths see realistic data too.
+
+"""
+
+import datetime
+import logging
+import random
+
+from google.appengine.ext import ndb
+
+import confstats
+import seats
+import textsearch
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceSpeakers
+from models import Profile
+from models import Registration
+from models import Session
+from models import Speaker
+from models import WishlistEntry
+
+VOLUMES = {
+    'conferences': 10000,
+    'sessions': 500000,
+    'speakers': 50000,
+    'profiles': 200000,
+}
+ORGANIZER_RATIO = 0.02      # of profiles, each organizing some conferences
+MAX_REGISTRATIONS = 5       # per profile
+MAX_WISHLIST = 10           # sessions per profile
+LEGACY_SESSION_RATIO = 0.05     # sessions still keyed by string speakerKey
+LEGACY_PROFILE_RATIO = 0.02     # profiles still holding list properties
+BATCH_SIZE = 500
+SAMPLE_SIZE = 500           # keys of each kind kept in the manifest
+
+CITIES = ['London', 'Paris', 'Berlin', 'New York', 'San Francisco', 'Tokyo',
+          'Chicago', 'Seattle', 'Boston', 'Austin', 'Toronto', 'Sydney',
+          'Dublin', 'Madrid', 'Amsterdam', 'Singapore', 'Bangalore', 'Zurich']
+TOPICS = ['Python', 'Cloud', 'Web', 'Mobile', 'Data', 'Security', 'DevOps',
+          'Machine Learning', 'Databases', 'Design', 'Go', 'Java', 'Testing',
+          'Performance', 'Networking', 'Games']
+SESSION_TYPES = ['lecture', 'workshop', 'keynote', 'panel', 'lightning']
+DURATIONS = [15, 30, 45, 60, 90, 120]
+CAPACITIES = [50, 100, 200, 500, 1000, 2000, 5000]
+WORDS = ['scaling', 'async', 'serverless', 'realtime', 'distributed',
+         'caching', 'indexing', 'streaming', 'testing', 'profiling', 'secure',
+         'mobile', 'graph', 'search', 'queues', 'storage', 'latency', 'design',
+         'patterns', 'pipelines', 'models', 'metrics', 'observability',
+         'migrations', 'sharding', 'consistency', 'transactions', 'apis']
+FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley',
+               'Jamie', 'Robin', 'Avery', 'Quinn', 'Drew', 'Kai', 'Noor']
+LAST_NAMES = ['Smith', 'Garcia', 'Chen', 'Okafor', 'Novak', 'Silva', 'Khan',
+              'Muller', 'Rossi', 'Kim', 'Nguyen', 'Haddad', 'Larsen', 'Ito']
+
+
+def _skewed(rng, n, skew=1.2):
+    """Pick an index below n, low indexes far more often (Zipf-like)."""
+    return min(n - 1, int(n * rng.random() ** (skew * 2)))
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def profileEmail(i):
+    return 'user%d@example.com' % i
+
+
+def _conferenceKey(i, organizer):
+    return ndb.Key(Conference, 'c%d' % i, parent=ndb.Key(Profile, organizer))
+
+
+def _putBatches(entities):
+    for start in range(0, len(entities), BATCH_SIZE):
+        ndb.put_multi(entities[start:start + BATCH_SIZE])
+
+
+def _index(entities):
+    for start in range(0, len(entities), BATCH_SIZE):
+        textsearch.indexEntities(entities[start:start + BATCH_SIZE])
+
+
+def _sample(rng, items):
+    items = list(items)
+    return rng.sample(items, min(SAMPLE_SIZE, len(items)))
+
+
+def _scaled(scale):
+    return dict((kind, max(1, int(count * scale)))
+                for kind, count in VOLUMES.items())
+
+
+def _planRegistrations(rng, volumes, capacities):
+    """Return ([conference indexes per profile], registrations per conference)."""
+    counts = [0] * volumes['conferences']
+    plan = []
+    for _ in range(volumes['profiles']):
+        chosen = set()
+        for _ in range(rng.randint(0, MAX_REGISTRATIONS)):
+            i = _skewed(rng, volumes['conferences'])
+            if i not in chosen and counts[i] < capacities[i]:
+                chosen.add(i)
+                counts[i] += 1
+        plan.append(sorted(chosen))
+    return plan, counts
+
+
+def _speakers(rng, volumes):
+    speakers = []
+    for i in range(volumes['speakers']):
+        name = '%s %s %d' % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), i)
+        speakers.append(Speaker(key=ndb.Key(Speaker, 'sp%d' % i),
+            speakerName=name,
+            speakerInfo='Works on %s.' % _words(rng, 6),
+            speakerContact='speaker%d@example.com' % i))
+    _putBatches(speakers)
+    _index(speakers)
+    return speakers
+
+
+def _conferences(rng, volumes, organizers, capacities, registered):
+    """Write conferences and their seat shards; return them."""
+    conferences = []
+    base = datetime.date(2026, 1, 1)
+    for i in range(volumes['conferences']):
+        start = base + datetime.timedelta(days=rng.randint(0, 729))
+        topics = rng.sample(TOPICS, rng.randint(1, 3))
+        conferences.append(Conference(
+            key=_conferenceKey(i, organizers[i % len(organizers)]),
+            name='%s %s %d' % (topics[0], _words(rng, 2).title(), i),
+            description=_words(rng, 12),
+            organizerUserId=organizers[i % len(organizers)],
+            topics=topics,
+            city=CITIES[_skewed(rng, len(CITIES), 0.6)],
+            startDate=start,
+            month=start.month,
+            endDate=start + datetime.timedelta(days=rng.randint(0, 4)),
+            maxAttendees=capacities[i],
+            seatsAvailable=capacities[i] - registered[i]))
+    _putBatches(conferences)
+    for start in range(0, len(conferences), BATCH_SIZE):
+        ndb.Future.wait_all([seats.initSeatsAsync(conf.key, conf.seatsAvailable)
+                             for conf in conferences[start:start + BATCH_SIZE]])
+    _index(conferences)
+    return conferences
+
+
+def _sessions(rng, volumes, conferences, speakers):
+    """Write sessions and speaker rosters; return sampled session keys."""
+    perConference, extra = divmod(volumes['sessions'], len(conferences))
+    sampled = []
+    batch = []
+    rosters = []
+    for i, conf in enumerate(conferences):
+        roster = ConferenceSpeakers(key=ConferenceApi._rosterKey(conf.key),
+                                    speakerKeys=[], sessionCounts={})
+        days = (conf.endDate - conf.startDate).days
+        for j in range(perConference + (1 if i < extra else 0)):
+            speaker = speakers[_skewed(rng, len(speakers))]
+            sess = Session(key=ndb.Key(Session, 's%d' % j, parent=conf.key),
+                session_name=_words(rng, 3).title(),
+                highlights=_words(rng, 8),
+                duration=rng.choice(DURATIONS),
+                typeOfSession=rng.choice(SESSION_TYPES),
+                startDate=conf.startDate + datetime.timedelta(
+                    days=rng.randint(0, days)),
+                startTime=datetime.time(rng.randint(8, 20), rng.choice([0, 30])))
+            if rng.random() < LEGACY_SESSION_RATIO:
+                # written before speakerKey became a KeyProperty and before
+                # names were denormalized
+                sess.legacySpeakerKey = speaker.key.urlsafe()
+            else:
+                sess.speakerKey = speaker.key
+                sess.speakerName = speaker.speakerName
+                sess.conferenceName = conf.name
+            ConferenceApi._countSession(roster, speaker.key)
+            batch.append(sess)
+            if len(sampled) < SAMPLE_SIZE * 4 and rng.random() < 0.01:
+                sampled.append(sess.key)
+        rosters.append(roster)
+        if len(batch) >= BATCH_SIZE * 4:
+            _putBatches(batch)
+            _index(batch)
+            batch = []
+        if len(rosters) >= BATCH_SIZE:
+            _putBatches(rosters)
+            rosters = []
+        if i % 1000 == 0:
+            logging.info('sessions: %d of %d conferences', i, len(conferences))
+    _putBatches(batch)
+    _index(batch)
+    _putBatches(rosters)
+    return sampled
+
+
+def _profiles(rng, volumes, plan, conferences, sessionKeys):
+    """Write profiles, registrations and wishlists."""
+    batch = []
+    for i in range(volumes['profiles']):
+        email = profileEmail(i)
+        key = ndb.Key(Profile, email)
+        wishlist = [rng.choice(sessionKeys)
+                    for _ in range(rng.randint(0, MAX_WISHLIST))]
+        wishlist = sorted(set(wishlist))
+        profile = Profile(key=key, displayName='User %d' % i, mainEmail=email)
+        if rng.random() < LEGACY_PROFILE_RATIO:
+            profile.conferenceKeysToAttend = [conferences[c].key.urlsafe()
+                                              for c in plan[i]]
+            profile.sessionWishlist = [sk.urlsafe() for sk in wishlist]
+            batch.append(profile)
+        else:
+            batch.append(profile)
+            batch.extend(Registration(
+                key=ConferenceApi._registrationKey(key, conferences[c].key.urlsafe()),
+                conference=conferences[c].key) for c in plan[i])
+            batch.extend(WishlistEntry(
+                key=ConferenceApi._wishlistKey(key, sk.urlsafe()), session=sk)
+                for sk in wishlist)
+        if len(batch) >= BATCH_SIZE * 4:
+            _putBatches(batch)
+            batch = []
+        if i % 10000 == 0:
+            logging.info('profiles: %d of %d', i, volumes['profiles'])
+    _putBatches(batch)
+
+
+def generate(seed=1, scale=1.0):
+    """Write the data set for seed and scale; return its manifest dict."""
+    rng = random.Random(seed)
+    volumes = _scaled(scale)
+    organizers = [profileEmail(i) for i in
+                  range(max(1, int(volumes['profiles'] * ORGANIZER_RATIO)))]
+    capacities = [rng.choice(CAPACITIES) for _ in range(volumes['conferences'])]
+    plan, registered = _planRegistrations(rng, volumes, capacities)
+
+    logging.info('generating %r (seed %d)', volumes, seed)
+    speakers = _speakers(rng, volumes)
+    conferences = _conferences(rng, volumes, organizers, capacities, registered)
+    sessionKeys = _sessions(rng, volumes, conferences, speakers)
+    _profiles(rng, volumes, plan, conferences, sessionKeys)
+    confstats.rebuildHistograms()
+    ConferenceApi._cacheAnnouncement()
+
+    sampledConfs = _sample(rng, conferences)
+    withRegistrations = [i for i in range(volumes['profiles']) if plan[i]]
+    return {
+        'seed': seed,
+        'scale': scale,
+        'volumes': volumes,
+        'conferences': [{'key': conf.key.urlsafe(),
+                         'organizer': conf.organizerUserId,
+                         'city': conf.city,
+                         'seatsAvailable': conf.seatsAvailable}
+                        for conf in sampledConfs],
+        'sessions': [key.urlsafe() for key in _sample(rng, sessionKeys)],
+        'speakers': [speaker.key.urlsafe() for speaker in _sample(rng, speakers)],
+        'profiles': [profileEmail(i) for i in _sample(rng, withRegistrations)],
+        'organizers': _sample(rng, organizers),
+        'nextProfile': volumes['profiles'],
+    }
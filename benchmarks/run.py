@@ -0,0 +1,1137 @@
+#!/usr/bin/env python
+
+"""run.py
+
+Offline benchmark suite for the conference API. Runs on the App Engine
+SDK's testbed (sqlite datastore_v3, memcache, taskqueue, mail stubs) over
+a seeded synthetic data set (see datagen.py), drives every ConferenceApi
+method and main.py handler, and reports latency percentiles and RPC
+counts per scenario. OAuth user-id lookups run against a local tokeninfo
+stand-in and check the cache, the access-token fallback, backoff and
+collapsed concurrent fetches. Search is timed against a brute-force scan
+it must agree with, and the converters against the reflective copy
+loops they replaced. The read endpoints are timed again with a latency
+given to every datastore read, to show how much of it overlaps. Last
+comes the registration throughput of one hot conference through
+registerForConference and through the xg Profile+Conference
+transaction it replaced. Results are compared against a stored
+baseline; a scenario that got slower, makes more RPCs or registers
+fewer per second than the baseline allows fails the run with a
+non-zero exit status. Latency limits are scaled by how long a fixed
+workload took against how long it took for the baseline, so a slower
+machine isn't taken for a regression.
+
+    python benchmarks/run.py --sdk ~/google_appengine [--scale 0.002]
+    python benchmarks/run.py --record     # write the baseline
+
+The SDK is found through --sdk, $APPENGINE_SDK or dev_appserver.py on
+PATH. Generated data is kept under benchmarks/.data per seed and scale
+and copied for each run, so runs start from identical data.
+
+"""
+
+import argparse
+import collections
+import distutils.spawn
+import gc
+import glob
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+DATA_DIR = os.path.join(HERE, '.data')
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+APP_ID = 'scalable-project-1028'
+
+# the baseline's data set: 100 conferences, 5k sessions, 500 speakers and
+# 2k profiles. Generating it takes about 6 minutes and a run about 17;
+# the full volumes (scale 1) don't finish on the stub in useful time.
+DEFAULT_SCALE = 0.01
+DEFAULT_ITERATIONS = 10
+
+LATENCY_TOLERANCE = 0.25    # fraction slower than baseline that still passes
+LATENCY_SLACK_MS = 2.0      # absolute slack for very fast scenarios
+RPC_TOLERANCE = 0.05
+THROUGHPUT_TOLERANCE = 0.25
+CALIBRATION_RUNS = 9        # samples of the machine-speed workload
+MAX_TASK_ROUNDS = 20        # chained task batches run per drain
+SEARCH_QUERIES = 10         # distinct queries timed on the index and a scan
+CONVERTER_ENTITIES = 500    # entities converted per converter sample
+TOKENINFO_LATENCY_MS = 50   # per fetch from the local tokeninfo stand-in
+TOKENINFO_WAITERS = 8       # threads looking up one uncached token at once
+
+THROUGHPUT_MODES = ('legacyXg', 'endpoint')    # see registrationThroughput
+THROUGHPUT_THREADS = 32
+THROUGHPUT_REGISTRATIONS = 500
+COMMIT_LATENCY_MS = 30      # injected before every commit, like production
+
+READ_LATENCY_MS = 20        # given to every datastore read by runReadLatency
+READ_CALLS = frozenset(['Get', 'RunQuery', 'Next'])
+READ_LATENCY_SCENARIOS = frozenset(['getConference', 'getConferencesCreated',
+    'getConferencesToAttend', 'getConferenceSessions',
+    'getConferenceSessionsPaged', 'getConferenceSchedule',
+    'getSessionsInWishlist', 'getSessionsBySpeaker', 'getSpeakersByConf',
+    'queryConferences:city'])
+
+
+def _findSdk(sdk):
+    """Return the App Engine SDK directory (the one holding dev_appserver.py)."""
+    candidates = [sdk, os.environ.get('APPENGINE_SDK')]
+    script = distutils.spawn.find_executable('dev_appserver.py')
+    if script:
+        binDir = os.path.dirname(os.path.realpath(script))
+        candidates += [binDir,
+                       os.path.join(binDir, '..', 'platform', 'google_appengine')]
+    for path in candidates:
+        if path and os.path.exists(os.path.join(path, 'dev_appserver.py')) \
+                and os.path.isdir(os.path.join(path, 'google', 'appengine')):
+            return os.path.abspath(path)
+    sys.exit('App Engine SDK not found; pass --sdk or set APPENGINE_SDK.')
+
+
+def _setupPaths(sdk):
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    try:
+        import endpoints
+    except ImportError:
+        # older SDKs leave the bundled endpoints library off the path
+        sys.path[1:1] = sorted(glob.glob(os.path.join(sdk, 'lib', 'endpoints-*')))[-1:]
+    sys.path.insert(0, ROOT)
+
+
+class _TokenInfoService(object):
+    """Local stand-in for the tokeninfo endpoint, behind the urlfetch stub.
+
+    Tokens starting 'down-' get 500s, tokens starting 'access-' are
+    rejected as id tokens but valid as access tokens, and any other token
+    belongs to user 'user-<token>'. Each fetch takes TOKENINFO_LATENCY_MS
+    and is counted per token.
+    """
+
+    def __init__(self):
+        self.fetches = collections.Counter()
+        self._lock = threading.Lock()
+
+    def matches(self, url):
+        from settings import TOKENINFO_URL
+        return url.startswith(TOKENINFO_URL.split('?')[0])
+
+    def fetch(self, url, payload, method, headers, request, response, **kwargs):
+        import urlparse
+
+        tokenType, tokens = urlparse.parse_qs(urlparse.urlsplit(url).query).items()[0]
+        token = tokens[0]
+        with self._lock:
+            self.fetches[token] += 1
+        time.sleep(TOKENINFO_LATENCY_MS / 1000.0)
+        if token.startswith('down-'):
+            status, body = 500, 'backend error'
+        elif token.startswith('access-') and tokenType != 'access_token':
+            status, body = 400, json.dumps({'error': 'invalid_token'})
+        else:
+            status, body = 200, json.dumps({'user_id': 'user-' + token,
+                                            'expires_in': 3600})
+        response.set_statuscode(status)
+        response.set_content(body)
+
+
+_tokenInfo = _TokenInfoService()
+
+
+def _startTestbed(datastoreFile):
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api.memcache import memcache_stub
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.setup_env(app_id=APP_ID, current_version_id='bench.1', overwrite=True)
+    # queries see every write, so results don't depend on replication luck
+    tb.init_datastore_v3_stub(datastore_file=datastoreFile, use_sqlite=True,
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    tb.init_memcache_stub()
+    # memcache's clock stands still, so what has expired (and so how many
+    # RPCs a call makes) doesn't depend on how fast the machine ran so far
+    started = time.time()
+    apiproxy_stub_map.apiproxy.ReplaceStub('memcache',
+        memcache_stub.MemcacheServiceStub(gettime=lambda: started))
+    tb.init_taskqueue_stub(root_path=ROOT)     # reads queue.yaml
+    tb.init_mail_stub()
+    tb.init_app_identity_stub()
+    tb.init_urlfetch_stub(urlmatchers=[(_tokenInfo.matches, _tokenInfo.fetch)])
+    tb.init_user_stub()
+    return tb
+
+
+def _stopTestbed(tb):
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+
+    ndb.get_context().clear_cache()
+    ndb.set_context(None)
+    stub = tb.get_stub(testbed.DATASTORE_SERVICE_NAME)
+    if hasattr(stub, 'Close'):
+        stub.Close()
+    tb.deactivate()
+
+
+def _dataFiles(seed, scale):
+    base = os.path.join(DATA_DIR, 'seed%d-scale%s' % (seed, scale))
+    return base + '.sqlite', base + '.json'
+
+
+def prepareData(seed, scale, regenerate=False):
+    """Generate the data set unless cached; return (sqlite path, manifest)."""
+    dataFile, manifestFile = _dataFiles(seed, scale)
+    if regenerate or not os.path.exists(manifestFile):
+        if not os.path.isdir(DATA_DIR):
+            os.makedirs(DATA_DIR)
+        for path in (dataFile, manifestFile):
+            if os.path.exists(path):
+                os.remove(path)
+        tb = _startTestbed(dataFile)
+        import datagen
+        start = time.time()
+        manifest = datagen.generate(seed, scale)
+        logging.info('generated data in %.0fs', time.time() - start)
+        _stopTestbed(tb)
+        with open(manifestFile, 'w') as f:
+            json.dump(manifest, f)
+    with open(manifestFile) as f:
+        return dataFile, json.load(f)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, rank)]
+
+
+def calibrate():
+    """Median ms of a fixed pure-Python workload: how fast this machine
+    runs right now. Latency limits are scaled by it against the baseline's."""
+    ms = []
+    for _ in range(CALIBRATION_RUNS):
+        start = time.time()
+        rows = [{'id': i, 'name': 'row %d' % i} for i in range(20000)]
+        json.loads(json.dumps(sorted(rows, key=lambda row: row['name'])))
+        ms.append((time.time() - start) * 1000)
+    return percentile(ms, 50)
+
+
+class Recorder(object):
+    """Times calls and counts their RPCs, per scenario."""
+
+    def __init__(self):
+        self.samples = {}
+        self._requestId = 0
+
+    def measure(self, name, fn):
+        """Run fn() as one sample of scenario name; return its result or None."""
+        from google.appengine.ext import ndb
+        import rpcstats
+
+        self._requestId += 1
+        os.environ['REQUEST_LOG_ID'] = 'bench-%d' % self._requestId
+        ndb.get_context().clear_cache()     # each call is a new request
+        gc.disable()    # as in timeit, collection pauses stay out of samples
+        rpcstats.begin()
+        start = time.time()
+        result = error = None
+        try:
+            result = fn()
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        finally:
+            gc.enable()
+        ms = (time.time() - start) * 1000
+        services = rpcstats.end()
+        if error:
+            logging.error('%s failed: %s', name, error)
+        self.samples.setdefault(name, []).append({
+            'ms': ms,
+            'rpcs': sum(counts['calls'] for counts in services.values()),
+            'datastore': services.get('datastore_v3', {}).get('calls', 0),
+            'error': error})
+        return result
+
+    def summary(self):
+        results = {}
+        for name, samples in self.samples.items():
+            ms = [s['ms'] for s in samples]
+            results[name] = {
+                'n': len(samples),
+                'errors': sum(1 for s in samples if s['error']),
+                'p50': percentile(ms, 50),
+                'p90': percentile(ms, 90),
+                'p99': percentile(ms, 99),
+                'meanRpcs': float(sum(s['rpcs'] for s in samples)) / len(samples),
+                'maxRpcs': max(s['rpcs'] for s in samples),
+                'meanDatastoreRpcs': float(sum(s['datastore'] for s in samples))
+                                     / len(samples),
+            }
+        return results
+
+
+class Inputs(object):
+    """Seeded picks from the manifest, plus state shared between scenarios."""
+
+    def __init__(self, manifest, seed):
+        self.manifest = manifest
+        self.rng = random.Random(seed)
+        self._next = manifest['nextProfile']
+        self.registered = []        # (email, wsck) made by registerForConference
+        self.wishlisted = []        # (email, wssk) made by addSessionToWishlist
+
+    def conference(self):
+        return self.rng.choice(self.manifest['conferences'])
+
+    def openConference(self):
+        return self.rng.choice([conf for conf in self.manifest['conferences']
+                                if conf['seatsAvailable'] > 0])
+
+    def session(self):
+        return self.rng.choice(self.manifest['sessions'])
+
+    def speaker(self):
+        return self.rng.choice(self.manifest['speakers'])
+
+    def profile(self):
+        return self.rng.choice(self.manifest['profiles'])
+
+    def organizer(self):
+        return self.rng.choice(self.manifest['organizers'])
+
+    def newUser(self):
+        """Email of a user with no profile yet."""
+        self._next += 1
+        return 'bench%d@example.com' % self._next
+
+    def word(self):
+        import datagen
+        return self.rng.choice(datagen.WORDS)
+
+    def city(self):
+        import datagen
+        return self.rng.choice(datagen.CITIES)
+
+    def topic(self):
+        import datagen
+        return self.rng.choice(datagen.TOPICS)
+
+
+def _request(method, **fields):
+    """Build the request message ConferenceApi.method expects."""
+    from conference import ConferenceApi
+    return getattr(ConferenceApi, method).remote.request_type(**fields)
+
+
+def _newApi():
+    """A ConferenceApi ready to be called outside the endpoints server."""
+    from conference import ConferenceApi
+    from protorpc import remote
+
+    api = ConferenceApi()
+    api.initialize_request_state(remote.HttpRequestState(
+        http_method='POST', service_path='/_ah/spi/ConferenceApi', headers={}))
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+    return api
+
+
+def _filters(*triples):
+    from models import ConferenceQueryForm
+    return [ConferenceQueryForm(field=field, operator=op, value=value)
+            for field, op, value in triples]
+
+
+def _sessionForm(inputs, i):
+    from models import SessionForm
+    return SessionForm(session_name='Bench Session %d' % i,
+        speakerKey=inputs.speaker(), duration=60, typeOfSession='lecture',
+        startDate='2026-06-01', startTime='%02d:00' % (9 + i % 8))
+
+
+# Each scenario builds (method, signed-in email, request) from the inputs.
+# Scenarios run in this order; pairs like register/unregister share state.
+def _scenarios(inputs):
+    from models import SpeakerForm
+    from models import TeeShirtSize
+
+    conferenceQueries = {
+        'city': lambda: _filters(('CITY', 'EQ', inputs.city())),
+        'cityMonth': lambda: _filters(('CITY', 'EQ', inputs.city()),
+                                      ('MONTH', 'GT', '6')),
+        'topicCapacity': lambda: _filters(('TOPIC', 'EQ', inputs.topic()),
+                                          ('MAX_ATTENDEES', 'GTEQ', '500')),
+    }
+
+    def owned(method, **fields):
+        conf = inputs.conference()
+        return (method, conf['organizer'],
+                _request(method, websafeConferenceKey=conf['key'], **fields))
+
+    def confRead(method, **fields):
+        return (method, inputs.profile(),
+                _request(method, websafeConferenceKey=inputs.conference()['key'],
+                         **fields))
+
+    def register():
+        email, conf = inputs.newUser(), inputs.openConference()
+        inputs.registered.append((email, conf['key']))
+        return ('registerForConference', email,
+                _request('registerForConference', websafeConferenceKey=conf['key']))
+
+    def unregister():
+        email, wsck = inputs.registered.pop(0)
+        return ('unregisterFromConference', email,
+                _request('unregisterFromConference', websafeConferenceKey=wsck))
+
+    def wishlistAdd():
+        email, wssk = inputs.newUser(), inputs.session()
+        inputs.wishlisted.append((email, wssk))
+        return ('addSessionToWishlist', email,
+                _request('addSessionToWishlist', sessionKey=wssk))
+
+    def wishlistDelete():
+        email, wssk = inputs.wishlisted.pop(0)
+        return ('deleteSessionFromWishlist', email,
+                _request('deleteSessionFromWishlist', sessionKey=wssk))
+
+    def importSessions():
+        conf = inputs.conference()
+        return ('importSessions', conf['organizer'], _request('importSessions',
+            websafeConferenceKey=conf['key'],
+            sessions=[_sessionForm(inputs, i) for i in range(20)]))
+
+    scenarios = [
+        # name, iterations (None: --iterations), build
+        ('getConference', None, lambda: confRead('getConference')),
+        ('getConferencesCreated', None, lambda: ('getConferencesCreated',
+            inputs.organizer(), _request('getConferencesCreated'))),
+        ('createConference', None, lambda: ('createConference',
+            inputs.organizer(), _request('createConference',
+                name='Bench %s' % inputs.word(), city=inputs.city(),
+                topics=[inputs.topic()], startDate='2026-05-01',
+                endDate='2026-05-03', maxAttendees=200))),
+        ('updateConference', None, lambda: owned('updateConference',
+            name='Renamed %s' % inputs.word(), description=inputs.word())),
+    ]
+    for variant, filters in sorted(conferenceQueries.items()):
+        scenarios += [
+            ('queryConferences:%s' % variant, None,
+             lambda filters=filters: ('queryConferences', inputs.profile(),
+                _request('queryConferences', filters=filters()))),
+            ('explainConferenceQuery:%s' % variant, None,
+             lambda filters=filters: ('explainConferenceQuery', inputs.profile(),
+                _request('explainConferenceQuery', filters=filters()))),
+            ('queryConferencesPaged:%s' % variant, None,
+             lambda filters=filters: ('queryConferencesPaged', inputs.profile(),
+                _request('queryConferencesPaged', filters=filters(), pageSize=20))),
+        ]
+    scenarios += [
+        ('queryConferencesPaged:unfiltered', None, lambda: (
+            'queryConferencesPaged', inputs.profile(),
+            _request('queryConferencesPaged', pageSize=20))),
+        ('addSpeaker', None, lambda: ('addSpeaker', inputs.profile(),
+            _request('addSpeaker', speakerName='Bench %s' % inputs.word(),
+                     speakerInfo=inputs.word(), speakerContact='bench@example.com'))),
+        ('importSpeakers', None, lambda: ('importSpeakers', inputs.profile(),
+            _request('importSpeakers', speakers=[
+                SpeakerForm(speakerName='Imported %d' % i, speakerInfo=inputs.word())
+                for i in range(20)]))),
+        ('getSpeakers', 2, lambda: ('getSpeakers', inputs.profile(),
+            _request('getSpeakers'))),
+        ('getSpeakersPaged', None, lambda: ('getSpeakersPaged', inputs.profile(),
+            _request('getSpeakersPaged', pageSize=50))),
+        ('getSpeakersByConf', None, lambda: confRead('getSpeakersByConf')),
+        ('getConferenceSchedule', None, lambda: confRead('getConferenceSchedule')),
+        ('search', None, lambda: ('search', inputs.profile(),
+            _request('search', query='%s %s' % (inputs.word(), inputs.word()[:3]),
+                     pageSize=20))),
+        ('getProfile', None, lambda: ('getProfile', inputs.profile(),
+            _request('getProfile'))),
+        ('saveProfile', None, lambda: ('saveProfile', inputs.profile(),
+            _request('saveProfile', displayName='Bench %s' % inputs.word(),
+                     teeShirtSize=TeeShirtSize.M_M))),
+        ('createSession', None, lambda: owned('createSession',
+            speakerKey=inputs.speaker(), session_name='Bench %s' % inputs.word(),
+            duration=45, typeOfSession='workshop', startDate='2026-06-02',
+            startTime='14:00')),
+        ('importSessions', None, importSessions),
+        ('getConferenceSessions', None, lambda: confRead('getConferenceSessions')),
+        ('getConferenceSessionsPaged', None, lambda: confRead(
+            'getConferenceSessionsPaged', pageSize=20)),
+        ('getConferenceSessionByType', None, lambda: confRead(
+            'getConferenceSessionByType', typeOfSession='workshop')),
+        ('getSessionsBySpeaker', None, lambda: ('getSessionsBySpeaker',
+            inputs.profile(), _request('getSessionsBySpeaker',
+                                       speakerKey=inputs.speaker()))),
+        ('getSessionsByTime', 2, lambda: ('getSessionsByTime', inputs.profile(),
+            _request('getSessionsByTime', startTime='10:00'))),
+        ('getWorkShopSessionBeforeSeven', 1, lambda: (
+            'getWorkShopSessionBeforeSeven', inputs.profile(),
+            _request('getWorkShopSessionBeforeSeven'))),
+        ('querySessions:speaker', None, lambda: ('querySessions',
+            inputs.profile(), _request('querySessions',
+                speakerKey=inputs.speaker(), pageSize=20))),
+        ('querySessions:conferenceType', None, lambda: ('querySessions',
+            inputs.profile(), _request('querySessions',
+                websafeConferenceKey=inputs.conference()['key'],
+                typeOfSession='workshop', pageSize=20))),
+        ('querySessions:timeDuration', None, lambda: ('querySessions',
+            inputs.profile(), _request('querySessions', startTimeFrom='09:00',
+                startTimeBefore='12:00', minDuration=60, pageSize=20))),
+        ('getConferencesToAttend', None, lambda: ('getConferencesToAttend',
+            inputs.profile(), _request('getConferencesToAttend'))),
+        ('getConferenceAttendees', None, lambda: owned('getConferenceAttendees',
+            pageSize=20)),
+        ('registerForConference', None, register),
+        ('unregisterFromConference', None, unregister),
+        ('getAnnouncement', None, lambda: ('getAnnouncement', inputs.profile(),
+            _request('getAnnouncement'))),
+        ('addSessionToWishlist', None, wishlistAdd),
+        ('deleteSessionFromWishlist', None, wishlistDelete),
+        ('getSessionsInWishlist', None, lambda: ('getSessionsInWishlist',
+            inputs.profile(), _request('getSessionsInWishlist'))),
+        ('getFeaturedSpeaker', None, lambda: ('getFeaturedSpeaker',
+            inputs.profile(), _request('getFeaturedSpeaker'))),
+        ('getConferenceFeaturedSpeaker', None, lambda: confRead(
+            'getConferenceFeaturedSpeaker')),
+    ]
+    return scenarios
+
+
+def _bruteForceSearch(text, kinds=None):
+    """Answer textsearch.search(text, kinds) by reading every searchable
+    entity and tokenizing its fields, the only way to search before the
+    index existed. Kept as the latency reference for the index and as
+    the oracle its results are checked against.
+    """
+    from models import Conference
+    from models import Session
+    from models import Speaker
+    import textsearch
+
+    terms = textsearch.tokenize(text)
+    if not terms:
+        return []
+    scores = {}
+    for model in (Conference, Session, Speaker):
+        if kinds and model.__name__ not in kinds:
+            continue
+        for entity in model.query().iter(batch_size=500):
+            frequencies = textsearch._termFrequencies(entity)
+            score = 0
+            for i, term in enumerate(terms):
+                if i == len(terms) - 1:
+                    tf = sum(count for word, count in frequencies.items()
+                             if word.startswith(term))
+                else:
+                    tf = frequencies.get(term, 0)
+                if not tf:
+                    break
+                score += tf
+            else:
+                scores[entity.key] = score
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0].urlsafe()))
+
+
+def _reflectiveCopy(entity, form):
+    """Copy entity to a new form message the way the _copy*ToForm helpers
+    did before converters.py: reflect over all_fields() for every entity,
+    choose a conversion from the field name, then check_initialized().
+    Kept as the reference the converter scenarios are timed against.
+    """
+    from models import Session
+    from models import TeeShirtSize
+
+    msg = form()
+    for field in msg.all_fields():
+        if hasattr(entity, field.name):
+            value = getattr(entity, field.name)
+            if field.name == 'teeShirtSize':
+                value = getattr(TeeShirtSize, value)
+            elif field.name.endswith('Date') or field.name.endswith('Time'):
+                value = str(value)
+            elif isinstance(entity, Session) and not field.name.endswith('uration'):
+                value = str(value)
+            setattr(msg, field.name, value)
+        elif field.name in ('websafeKey', 'websafeSessionKey'):
+            setattr(msg, field.name, entity.key.urlsafe())
+    msg.check_initialized()
+    return msg
+
+
+# Scenarios that time library code directly instead of an endpoint:
+# name, iterations (None: --iterations), fn(i) for the i-th sample.
+def _directScenarios(inputs):
+    import converters
+    import textsearch
+    import tokeninfo
+    import utils
+
+    queries = ['%s %s' % (inputs.word(), inputs.word()[:3])
+               for _ in range(SEARCH_QUERIES)]
+    scanned = {}
+
+    def searchScan(i):
+        query = queries[i % len(queries)]
+        scanned[query] = _bruteForceSearch(query)
+
+    def searchIndex(i):
+        query = queries[i % len(queries)]
+        if textsearch.search(query) != scanned.get(query, []):
+            raise RuntimeError('index and scan disagree on %r' % query)
+
+    def expect(what, actual, expected):
+        if actual != expected:
+            raise RuntimeError('%s: got %r, expected %r' % (what, actual, expected))
+
+    # tokeninfo lookups check their answer and how many fetches it took
+    def tokenMiss(i):
+        token = 'tok-%d' % i
+        expect(token, tokeninfo.lookupUserId(token), 'user-' + token)
+        expect('%s fetches' % token, _tokenInfo.fetches[token], 1)
+
+    def tokenHit(i):
+        token = 'tok-%d' % i      # cached by tokenMiss(i)
+        expect(token, tokeninfo.lookupUserId(token), 'user-' + token)
+        expect('%s fetches' % token, _tokenInfo.fetches[token], 1)
+
+    def tokenMemcache(i):
+        token = 'tok-%d' % i
+        tokeninfo._userIds = tokeninfo.LruCache(tokeninfo.LRU_SIZE)  # new instance
+        expect(token, tokeninfo.lookupUserId(token), 'user-' + token)
+        expect('%s fetches' % token, _tokenInfo.fetches[token], 1)
+
+    def tokenAccessFallback(i):
+        token = 'access-%d' % i
+        expect(token, tokeninfo.lookupUserId(token), 'user-' + token)
+        expect('%s fetches' % token, _tokenInfo.fetches[token], 2)
+
+    def tokenBackoff(i):
+        token = 'down-%d' % i
+        expect(token, tokeninfo.lookupUserId(token), '')
+        expect('%s again' % token, tokeninfo.lookupUserId(token), '')
+        expect('%s fetches' % token, _tokenInfo.fetches[token],
+               len(tokeninfo.ATTEMPT_DEADLINES))
+
+    def tokenConcurrent(i):
+        token = 'shared-%d' % i
+        userIds = []
+        workers = [threading.Thread(
+                       target=lambda: userIds.append(tokeninfo.lookupUserId(token)))
+                   for _ in range(TOKENINFO_WAITERS)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        expect(token, userIds, ['user-' + token] * TOKENINFO_WAITERS)
+        expect('%s fetches' % token, _tokenInfo.fetches[token], 1)
+
+    def oauthUserId(i):
+        token = 'tok-%d' % i
+        os.environ['HTTP_AUTHORIZATION'] = 'Bearer %s' % token
+        try:
+            expect(token, utils.getUserId(None, id_type='oauth'), 'user-' + token)
+        finally:
+            del os.environ['HTTP_AUTHORIZATION']
+
+    scenarios = [
+        ('tokeninfo:miss', None, tokenMiss),
+        ('tokeninfo:hit', None, tokenHit),
+        ('tokeninfo:memcache', None, tokenMemcache),
+        ('tokeninfo:accessFallback', None, tokenAccessFallback),
+        ('tokeninfo:backoff', None, tokenBackoff),
+        ('tokeninfo:concurrent', None, tokenConcurrent),
+        ('getUserId:oauth', None, oauthUserId),
+        ('textsearch:scan', SEARCH_QUERIES, searchScan),
+        ('textsearch:index', SEARCH_QUERIES, searchIndex),
+    ]
+    for (model, form), converter in sorted(converters._registry.items(),
+                                           key=lambda item: item[0][0].__name__):
+        entities = model.query().fetch(CONVERTER_ENTITIES)
+        scenarios += [
+            ('converters:%s:reflective' % model.__name__, None,
+             lambda i, entities=entities, form=form:
+                 [_reflectiveCopy(entity, form) for entity in entities]),
+            ('converters:%s:precompiled' % model.__name__, None,
+             lambda i, entities=entities, converter=converter:
+                 converter.convertAll(entities)),
+        ]
+    return scenarios
+
+
+# main.py handlers started directly; task handlers they and the API calls
+# queue are run (and measured) when the default queue is drained
+HANDLERS = [
+    # name, iterations (None: --iterations), method, path
+    ('/crons/set_announcement', 3, 'GET', '/crons/set_announcement'),
+    ('/crons/apply_histograms', None, 'GET', '/crons/apply_histograms'),
+    ('/crons/send_notifications', None, 'GET', '/crons/send_notifications'),
+    ('/crons/refresh_conference_stats', 1, 'GET', '/crons/refresh_conference_stats'),
+    ('/tasks/sync_session_names', 1, 'GET', '/tasks/sync_session_names'),
+    ('/tasks/migrate_session_speakers', 1, 'GET', '/tasks/migrate_session_speakers'),
+    ('/tasks/migrate_profile_lists', 1, 'GET', '/tasks/migrate_profile_lists'),
+    ('/tasks/reindex_search', 1, 'GET', '/tasks/reindex_search'),
+    ('/_ah/warmup', 3, 'GET', '/_ah/warmup'),
+    ('/admin/stats', None, 'GET', '/admin/stats'),
+]
+
+
+def _callHandler(method, path, body=None):
+    import webapp2
+    import main
+
+    headers = {}
+    if body is not None:
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    request = webapp2.Request.blank(path, method=method, headers=headers)
+    if body is not None:
+        request.body = body
+    response = request.get_response(main.app)
+    if response.status_int >= 400:
+        raise RuntimeError('%s %s returned %s' % (method, path, response.status))
+    return response
+
+
+def drainTasks(recorder, tb):
+    """Run queued push tasks through main.app, measuring each by URL."""
+    from google.appengine.ext import testbed
+
+    taskqueueStub = tb.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    for _ in range(MAX_TASK_ROUNDS):
+        tasks = taskqueueStub.get_filtered_tasks(queue_names=['default'])
+        if not tasks:
+            return
+        taskqueueStub.FlushQueue('default')
+        for task in tasks:
+            recorder.measure('task %s' % task.url,
+                lambda task=task: _callHandler('POST', task.url, task.payload or ''))
+    # long chains (backfills) only get their first rounds measured
+    taskqueueStub.FlushQueue('default')
+
+
+def runScenarios(recorder, tb, inputs, iterations):
+    api = _newApi()
+    for name, count, build in _scenarios(inputs):
+        for _ in range(count or iterations):
+            method, email, request = build()
+            os.environ['ENDPOINTS_AUTH_EMAIL'] = email or ''
+            recorder.measure(name, lambda: getattr(api, method)(request))
+        drainTasks(recorder, tb)
+    for name, count, fn in _directScenarios(inputs):
+        for i in range(count or iterations):
+            recorder.measure(name, lambda: fn(i))
+
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = ''
+    for name, count, method, path in HANDLERS:
+        for _ in range(count or iterations):
+            recorder.measure(name, lambda: _callHandler(method, path))
+        drainTasks(recorder, tb)
+    # queued by the previous release; forwarded to the notifications queue
+    for _ in range(iterations):
+        recorder.measure('/tasks/send_confirmation_email',
+            lambda: _callHandler('POST', '/tasks/send_confirmation_email',
+                'email=bench%40example.com&conferenceInfo=Bench'))
+    drainTasks(recorder, tb)
+
+
+class _CommitHook(object):
+    """Datastore pre-call hook that delays and counts commits while enabled.
+
+    The stub commits instantly, so concurrent transactions on one entity
+    group barely overlap; the delay gives them production-like windows
+    in which to conflict, and retried transactions show up as extra
+    commits.
+    """
+
+    def __init__(self):
+        self.seconds = None     # None: disabled
+        self.commits = 0
+        self._lock = threading.Lock()
+
+    def hook(self, service, call, request, response):
+        if self.seconds is None or call != 'Commit':
+            return
+        with self._lock:
+            self.commits += 1
+        time.sleep(self.seconds)
+
+
+class _ReadLatencyHook(object):
+    """Datastore hooks that give every read a fixed latency while enabled.
+
+    A read is due that long after it is issued, and waiting on it sleeps
+    until then, so reads issued together overlap as they would against
+    the real datastore while reads issued one after another each pay in
+    full. The stub itself still answers instantly.
+    """
+
+    def __init__(self):
+        self.seconds = None     # None: disabled
+        self.reads = 0
+
+    def issue(self, service, call, request, response, rpc):
+        if self.seconds is None or call not in READ_CALLS:
+            return
+        self.reads += 1
+        if rpc is None:
+            time.sleep(self.seconds)
+        else:
+            rpc.benchDue = time.time() + self.seconds
+
+    def wait(self, service, call, request, response, rpc):
+        due = getattr(rpc, 'benchDue', None)
+        if due is not None:
+            time.sleep(max(0, due - time.time()))
+
+
+def runReadLatency(inputs, iterations, latencyMs):
+    """Time the read endpoints with latencyMs added to every datastore read.
+
+    Each sample runs without and then with the latency, after a warm-up
+    run (the stub is slow the first time it reads an entity), and
+    memcache is flushed before each run so the reads reach the datastore.
+    addedMs is the wall-clock time the latency added at p50, next to
+    serialMs, what the sample's reads would add issued one after another;
+    the gap is the overlap tasklets buy. The stub's CPU time can't
+    overlap, so it is left out of both.
+    """
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import memcache
+
+    readHook = _ReadLatencyHook()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'benchReadIssue', readHook.issue, 'datastore_v3')
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'benchReadWait', readHook.wait, 'datastore_v3')
+    api = _newApi()
+    warmup, idle, delayed = Recorder(), Recorder(), Recorder()
+    reads = {}
+    try:
+        for name, count, build in _scenarios(inputs):
+            if name not in READ_LATENCY_SCENARIOS:
+                continue
+            for _ in range(count or iterations):
+                method, email, request = build()
+                os.environ['ENDPOINTS_AUTH_EMAIL'] = email or ''
+                for recorder, seconds in ((warmup, 0.0), (idle, 0.0),
+                                          (delayed, latencyMs / 1000.0)):
+                    memcache.flush_all()
+                    readHook.seconds = seconds
+                    readHook.reads = 0
+                    recorder.measure(name, lambda: getattr(api, method)(request))
+                reads.setdefault(name, []).append(readHook.reads)
+    finally:
+        readHook.seconds = None
+    results = delayed.summary()
+    idleResults = idle.summary()
+    for name, result in results.items():
+        result['meanReads'] = float(sum(reads[name])) / len(reads[name])
+        result['serialMs'] = result['meanReads'] * latencyMs
+        result['addedMs'] = result['p50'] - idleResults[name]['p50']
+    return results
+
+
+def _legacyRegistration(profKey, confKey):
+    """Register profKey the way _conferenceRegistration did before seat
+    sharding: one xg transaction over the Profile and the Conference,
+    rewriting seatsAvailable on the conference entity. Kept here as the
+    throughput reference; run it with ndb.transactional(xg=True).
+    """
+    from models import Profile
+
+    prof = profKey.get()
+    if not prof:
+        prof = Profile(key=profKey, displayName=profKey.id(),
+                       mainEmail=profKey.id())
+    conf = confKey.get()
+    wsck = confKey.urlsafe()
+    if wsck in prof.conferenceKeysToAttend or conf.seatsAvailable <= 0:
+        return False
+    prof.conferenceKeysToAttend.append(wsck)
+    conf.seatsAvailable -= 1
+    prof.put()
+    conf.put()
+    return True
+
+
+def _hotConference(name, seats):
+    """Create a conference with seats seats and its organizer; return it."""
+    from google.appengine.ext import ndb
+    from models import Conference
+    from models import Profile
+    import seats as seatShards
+
+    organizer = Profile(key=ndb.Key(Profile, '%s@example.com' % name),
+                        displayName=name, mainEmail='%s@example.com' % name)
+    conf = Conference(key=ndb.Key(Conference, name, parent=organizer.key),
+                      name=name, organizerUserId=organizer.key.id(),
+                      seatsAvailable=seats, maxAttendees=seats)
+    ndb.put_multi([organizer, conf])
+    seatShards.initSeats(conf.key, seats)
+    return conf
+
+
+def registrationThroughput(commitHook, mode, threads, registrations, latencyMs):
+    """Register distinct users into one hot conference from many threads.
+
+    mode 'endpoint' calls registerForConference, each call as its own
+    request with its own signed-in user; mode 'legacyXg' runs the
+    pre-sharding transaction (see _legacyRegistration). Returns
+    registrations per second and datastore commits per registration.
+    """
+    from google.appengine.ext import ndb
+    from google.appengine.runtime import request_environment
+    from models import Profile
+
+    conf = _hotConference('hot-%s' % mode, registrations)
+    legacy = ndb.transactional(xg=True)(_legacyRegistration)
+    counts = {'registered': 0, 'failed': 0}
+    lock = threading.Lock()
+    baseEnviron = dict(os.environ)
+
+    def register(i):
+        email = 'hot-%s-%d@example.com' % (mode, i)
+        if mode == 'legacyXg':
+            return legacy(ndb.Key(Profile, email), conf.key)
+        # os.environ is per thread here, as in the threadsafe runtime
+        api = _newApi()
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+        os.environ['REQUEST_LOG_ID'] = 'hot-%s-%d' % (mode, i)
+        ndb.get_context().clear_cache()
+        return api.registerForConference(_request('registerForConference',
+            websafeConferenceKey=conf.key.urlsafe())).data
+
+    def worker(n):
+        request_environment.current_request.Init(None, dict(baseEnviron))
+        for i in range(n, registrations, threads):
+            try:
+                registered = register(i)
+            except Exception as e:
+                logging.warning('%s registration %d failed: %s: %s',
+                                mode, i, type(e).__name__, e)
+                registered = False
+            with lock:
+                counts['registered' if registered else 'failed'] += 1
+
+    environ = os.environ
+    request_environment.current_request.Init(None, dict(baseEnviron))
+    request_environment.PatchOsEnviron()
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    commitHook.commits = 0
+    commitHook.seconds = latencyMs / 1000.0
+    try:
+        start = time.time()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        commitHook.seconds = None
+        os.environ = environ
+    return {
+        'mode': mode,
+        'threads': threads,
+        'registered': counts['registered'],
+        'failed': counts['failed'],
+        'seconds': elapsed,
+        'perSecond': counts['registered'] / elapsed if elapsed else 0.0,
+        'commitsPerRegistration': float(commitHook.commits) /
+                                  counts['registered']
+                                  if counts['registered'] else 0.0,
+    }
+
+
+def runThroughput(args):
+    from google.appengine.api import apiproxy_stub_map
+
+    commitHook = _CommitHook()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'benchCommits', commitHook.hook, 'datastore_v3')
+    results = {}
+    for mode in THROUGHPUT_MODES:
+        results['registrationThroughput:%s' % mode] = registrationThroughput(
+            commitHook, mode, args.threads, args.registrations,
+            args.commit_latency_ms)
+    return results
+
+
+def compare(current, baseline, args):
+    """Return a list of regressions of current against baseline."""
+    problems = []
+    for key in ('seed', 'scale', 'iterations', 'readLatencyMs'):
+        if current[key] != baseline.get(key):
+            problems.append('baseline was recorded with %s=%r, this run used %r'
+                            % (key, baseline.get(key), current[key]))
+    # how much slower this machine ran than the baseline's; p90 of a few
+    # samples is close to the max, so only p50 is held to the limits
+    speed = current['calibrationMs'] / baseline.get('calibrationMs',
+                                                    current['calibrationMs'])
+    for name, base in sorted(baseline['scenarios'].items()):
+        result = current['scenarios'].get(name)
+        if result is None:
+            problems.append('%s: not run' % name)
+            continue
+        if result['errors'] > base['errors']:
+            problems.append('%s: %d errors (baseline %d)'
+                            % (name, result['errors'], base['errors']))
+        limit = base['p50'] * speed * (1 + args.latency_tolerance) \
+            + LATENCY_SLACK_MS
+        if result['p50'] > limit:
+            problems.append('%s: p50 %.1fms > %.1fms allowed (baseline %.1fms)'
+                            % (name, result['p50'], limit, base['p50']))
+        limit = base['meanRpcs'] * (1 + RPC_TOLERANCE)
+        if result['meanRpcs'] > limit:
+            problems.append('%s: %.1f RPCs per call > %.1f allowed (baseline %.1f)'
+                            % (name, result['meanRpcs'], limit, base['meanRpcs']))
+    for name, base in sorted(baseline.get('readLatency', {}).items()):
+        result = current['readLatency'].get(name)
+        if result is None:
+            problems.append('readLatency %s: not run' % name)
+            continue
+        limit = base['p50'] * speed * (1 + args.latency_tolerance) \
+            + LATENCY_SLACK_MS
+        if result['p50'] > limit:
+            problems.append('readLatency %s: p50 %.1fms > %.1fms allowed '
+                            '(baseline %.1fms)'
+                            % (name, result['p50'], limit, base['p50']))
+    for name, base in sorted(baseline.get('throughput', {}).items()):
+        result = current['throughput'].get(name)
+        if result is None:
+            problems.append('%s: not run' % name)
+            continue
+        limit = base['perSecond'] / speed * (1 - THROUGHPUT_TOLERANCE)
+        if result['perSecond'] < limit:
+            problems.append('%s: %.0f/s < %.0f/s allowed (baseline %.0f/s)'
+                            % (name, result['perSecond'], limit, base['perSecond']))
+    return problems
+
+
+def report(current):
+    print('%-46s %5s %4s %9s %9s %9s %8s' % (
+        'scenario', 'n', 'err', 'p50 ms', 'p90 ms', 'p99 ms', 'rpcs'))
+    for name, result in sorted(current['scenarios'].items()):
+        print('%-46s %5d %4d %9.1f %9.1f %9.1f %8.1f' % (
+            name, result['n'], result['errors'], result['p50'], result['p90'],
+            result['p99'], result['meanRpcs']))
+    print('\n%-46s %5s %9s %9s %8s %9s' % (
+        'read endpoint, %gms per datastore read' % current['readLatencyMs'],
+        'n', 'p50 ms', 'added ms', 'reads', 'serial ms'))
+    for name, result in sorted(current['readLatency'].items()):
+        print('%-46s %5d %9.1f %9.1f %8.1f %9.1f' % (
+            name, result['n'], result['p50'], result['addedMs'],
+            result['meanReads'], result['serialMs']))
+    print('')
+    for name, result in sorted(current['throughput'].items()):
+        print('%-46s %d registered, %d failed, %.0f/s, %.1f commits each' % (
+            name, result['registered'], result['failed'], result['perSecond'],
+            result['commitsPerRegistration']))
+    print('\nmachine speed: %.1fms per calibration workload'
+          % current['calibrationMs'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', help='App Engine SDK directory')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scale', type=float, default=DEFAULT_SCALE,
+                        help='fraction of the datagen.VOLUMES data volumes')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS,
+                        help='samples per scenario (heavy ones take fewer)')
+    parser.add_argument('--threads', type=int, default=THROUGHPUT_THREADS)
+    parser.add_argument('--registrations', type=int,
+                        default=THROUGHPUT_REGISTRATIONS)
+    parser.add_argument('--commit-latency-ms', type=float,
+                        default=COMMIT_LATENCY_MS)
+    parser.add_argument('--read-latency-ms', type=float,
+                        default=READ_LATENCY_MS)
+    parser.add_argument('--latency-tolerance', type=float,
+                        default=LATENCY_TOLERANCE)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--record', action='store_true',
+                        help='write this run as the baseline instead of comparing')
+    parser.add_argument('--regenerate', action='store_true',
+                        help='regenerate the cached data set')
+    parser.add_argument('--output', help='also write results as JSON here')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    _setupPaths(_findSdk(args.sdk))
+    random.seed(args.seed)      # seats.py picks shards with the global RNG
+    dataFile, manifest = prepareData(args.seed, args.scale, args.regenerate)
+
+    workDir = tempfile.mkdtemp(prefix='conference-bench-')
+    try:
+        runFile = os.path.join(workDir, 'datastore.sqlite')
+        shutil.copyfile(dataFile, runFile)
+        tb = _startTestbed(runFile)
+        import rpcstats
+        rpcstats.install()      # hooks live on the testbed's apiproxy
+
+        calibrationMs = calibrate()
+        recorder = Recorder()
+        runScenarios(recorder, tb, Inputs(manifest, args.seed), args.iterations)
+        current = {
+            'seed': args.seed,
+            'scale': args.scale,
+            'iterations': args.iterations,
+            'scenarios': recorder.summary(),
+            'readLatencyMs': args.read_latency_ms,
+            'readLatency': runReadLatency(Inputs(manifest, args.seed),
+                                          args.iterations, args.read_latency_ms),
+            'throughput': runThroughput(args),
+        }
+        # the machine's speed can drift over a run; take it at both ends
+        current['calibrationMs'] = (calibrationMs + calibrate()) / 2
+        _stopTestbed(tb)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    report(current)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.record:
+        with open(args.baseline, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print('Baseline written to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        sys.stderr.write('No baseline at %s; run with --record on the '
+                         'reference machine first.\n' % args.baseline)
+        return 2
+    with open(args.baseline) as f:
+        problems = compare(current, json.load(f), args)
+    if problems:
+        sys.stderr.write('\nPERFORMANCE REGRESSION (%d):\n' % len(problems))
+        for problem in problems:
+            sys.stderr.write('  %s\n' % problem)
+        return 1
+    print('\nNo regressions against %s' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
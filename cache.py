@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Read-through memcache layer for the hot Conference, Speaker and Profile
+entities. Entries are keyed by entity key under a versioned prefix; bump
+CACHE_VERSION whenever a cached model changes shape. Writers call
+invalidate() after their put, which replaces the entry with a short-lived
+lock value. Readers that miss fill the entry with compare-and-set, so a
+read that started before the invalidation can't put a stale copy back.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+CACHE_VERSION = 1
+CACHE_TTL = 600
+# profiles are per user and change more often, so they expire sooner
+KIND_TTLS = {'Profile': 60}
+MEMCACHE_ENTITY_KEY = "ENTITY:v%d:%s"
+# placeholder held by invalidate() and by readers filling a miss
+_LOCKED = 0
+LOCK_TTL = 32   # seconds; longer than any read-through takes
+
+# per-instance hit/miss counters, see getStats()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _cacheKey(key):
+    """Return the memcache key for an entity key."""
+    return MEMCACHE_ENTITY_KEY % (CACHE_VERSION, key.urlsafe())
+
+
+@ndb.tasklet
+def getMultiAsync(keys):
+    """Tasklet version of getMulti.
+
+    Memcache calls go through the ndb context's auto-batcher, so lookups
+    from tasklets running side by side share memcache round trips as well
+    as datastore ones. A miss adds the lock value and reads it back with
+    gets() before going to datastore; the entity is only cached if the
+    cas() finds that value unchanged, i.e. nobody invalidated meanwhile.
+    """
+    keys = list(keys)
+    if not keys:
+        raise ndb.Return([])
+    ctx = ndb.get_context()
+    cacheKeys = [_cacheKey(key) for key in keys]
+    values = yield [ctx.memcache_get(cacheKey) for cacheKey in cacheKeys]
+    cached = dict((cacheKey, value) for cacheKey, value in zip(cacheKeys, values)
+                  if value is not None and value != _LOCKED)
+
+    missing = list(set(key for key, cacheKey in zip(keys, cacheKeys)
+                       if cacheKey not in cached))
+    _stats['hits'] += len(keys) - len(missing)
+    _stats['misses'] += len(missing)
+
+    fetched = {}
+    if missing:
+        missingKeys = [_cacheKey(key) for key in missing]
+        yield [ctx.memcache_add(cacheKey, _LOCKED, time=LOCK_TTL)
+               for cacheKey in missingKeys]
+        leases = yield [ctx.memcache_gets(cacheKey) for cacheKey in missingKeys]
+        entities = yield ndb.get_multi_async(missing, use_memcache=False)
+        fetched = dict(zip(missing, entities))
+        yield [ctx.memcache_cas(cacheKey, entity,
+                                time=KIND_TTLS.get(key.kind(), CACHE_TTL))
+               for key, cacheKey, lease, entity
+               in zip(missing, missingKeys, leases, entities)
+               if entity and lease == _LOCKED]
+
+    raise ndb.Return([cached[cacheKey] if cacheKey in cached else fetched.get(key)
+                      for key, cacheKey in zip(keys, cacheKeys)])
+
+
+def getMulti(keys):
+    """Return entities for keys (None where missing), reading through memcache.
+
+    Not for use inside transactions: reads there must come from datastore.
+    """
+    return getMultiAsync(keys).get_result()
+
+
+def get(key):
+    """Return the entity for key, or None, reading through memcache."""
+    return getMulti([key])[0]
+
+
+def invalidate(*keys):
+    """Lock out cached entries for keys; call after writing those entities.
+
+    Setting the lock value, rather than deleting, changes the entry's
+    CAS id, so any read-through already in flight fails its cas().
+    """
+    memcache.set_multi(dict((_cacheKey(key), _LOCKED) for key in keys if key),
+                       time=LOCK_TTL)
+
+
+def getStats():
+    """Return this instance's cache hit/miss counters."""
+    lookups = _stats['hits'] + _stats['misses']
+    stats = dict(_stats)
+    stats['hitRatio'] = float(_stats['hits']) / lookups if lookups else 0.0
+    return stats
@@ -13,45 +13,102 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import calendar
+import csv
+from cStringIO import StringIO
 from datetime import datetime
+from datetime import time
+import itertools
+import logging
+from time import sleep
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 from models import ConflictException
+from models import Announcement
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import ProfileForms
+from models import Registration
+from models import WishlistEntry
 from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
-from models import TeeShirtSize
+from models import ConferenceSpeakers
 from models import StringMessage
+from models import QueryPlanForm
 from models import Session
 from models import SessionForm
 from models import SessionForms
 from models import SessionFormByConference
+from models import SessionQueryForm
+from models import ImportSessionsForm
+from models import ImportSpeakersForm
+from models import ImportRowResult
+from models import ImportResultForms
 from models import Speaker
 from models import SpeakerForm
 from models import SpeakerForms
-
-from utils import getUserId
+from models import SearchForm
+from models import SearchResultForm
+from models import SearchResultForms
+from models import ScheduleDayForm
+from models import ScheduleForm
+from models import ScheduleSlotForm
+
+from converters import CONFERENCE_CONVERTER
+from converters import PROFILE_CONVERTER
+from converters import SESSION_CONVERTER
+from converters import SPEAKER_CONVERTER
+import cache
+import confstats
+import dispatch
+import identity
+import notify
+import rpcstats
+from confstats import COMPARISONS
+import seats
+import textsearch
 
 from settings import WEB_CLIENT_ID
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_ANNOUNCEMENTS_LOCK = "RECENT_ANNOUNCEMENTS:lock"
+ANNOUNCEMENT_LOCK_TTL = 10      # seconds
+ANNOUNCEMENT_WAIT_POLLS = 5     # memcache polls by callers that lose the lock
+ANNOUNCEMENT_WAIT_INTERVAL = 0.05   # seconds between polls
+ANNOUNCEMENT_MAX_SEATS = 5
+ANNOUNCEMENT_CAS_RETRIES = 5
+# last announcement text this instance saw; served while another request
+# rebuilds the memcache copy
+_lastAnnouncement = [None]
 MEMCACHE_SPEAKER_KEY = "SET_SPEAKER"
+MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER:%s"
+DEFAULT_PAGE_SIZE = 20
+SESSION_QUERY_SCAN_LIMIT = 1000
+WORKSHOP_QUERY_MAX_PAGES = 10   # scan-limited pages per getWorkshopSessionBeforeSeven call
+CONFERENCE_QUERY_SCAN_LIMIT = 1000
+SESSION_BATCH_SIZE = 100
+PROFILE_BATCH_SIZE = 100
+IMPORT_BATCH_SIZE = 200
+MAX_PAGE_SIZE = 100
+MEMCACHE_SCHEDULE_VERSION_KEY = "SCHEDULE_VERSION:%s"
+MEMCACHE_SCHEDULE_KEY = "SCHEDULE:%s:%s"
+SCHEDULE_CACHE_TTL = 3600
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -78,6 +135,11 @@ FIELDS =    {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
+# session filter fields, most selective first; the planner sends filters
+# on the first field present to datastore and checks the rest in memory
+SESSION_FILTER_ORDER = ['speakerKey', 'typeOfSession', 'startDate',
+                        'startTime', 'duration']
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
@@ -88,6 +150,36 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_QUERY_PAGE_REQUEST = endpoints.ResourceContainer(
+    ConferenceQueryForms,
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
+PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
+)
+
+PAGE_TOKEN_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageToken=messages.StringField(1),
+)
+
+CONF_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
+SCHEDULE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
 SESSION_CREATE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey = messages.StringField(1),
@@ -136,35 +228,32 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf, displayName, seatsAvailable=None):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        if seatsAvailable is None:
+            seatsAvailable = seats.getSeatsAvailable([conf])[conf.key]
+        # live seat count comes from the seat shards, not the entity
+        cf = CONFERENCE_CONVERTER.convert(conf, seatsAvailable=seatsAvailable)
         if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
+            cf.organizerDisplayName = displayName
         return cf
 
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        ident = identity.current()
+        user = ident.requireUser()
+        user_id = ident.userId
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
 
+        # generate Profile Key based on user ID and allocate the Conference
+        # ID under it while the rest of the request is processed
+        p_key = ndb.Key(Profile, user_id)
+        idFuture = Conference.allocate_ids_async(size=1, parent=p_key)
+
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
@@ -188,31 +277,73 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
+        # get Conference key from the allocated ID
+        c_key = ndb.Key(Conference, idFuture.get_result()[0], parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
         # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        # creation of Conference & return (modified) ConferenceForm.
+        # seat shards are root entities, so they're written alongside
+        seatsFuture = seats.initSeatsAsync(c_key, data['seatsAvailable'])
+        conf = Conference(**data)
         # TODO 2: add confirmation email sending task to queue
-        taskqueue.add(params={'email': user.email(), 'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email')
+        self._commitConference(conf, user.email(), request)
+        seatsFuture.get_result()
+        self._updateAnnouncement(c_key, data['name'], data['seatsAvailable'])
+        notify.wakeWorker()
+        confstats.wakeWorker()
 
         return request
 
 
+    @staticmethod
+    @ndb.transactional()
+    def _commitConference(conf, email, request):
+        """Put a new conference with its indexing, confirmation and stats tasks.
+
+        The tasks are enqueued transactionally, so they exist if and only
+        if the conference does; the four RPCs run concurrently.
+        """
+        rpcs = [conf.put_async(),
+                ConferenceApi._indexLater([conf.key]),
+                notify.queueNotificationAsync('conferenceCreated', email,
+                    transactional=True, name=request.name,
+                    city=request.city or '', startDate=request.startDate or '',
+                    endDate=request.endDate or '',
+                    topics=', '.join(request.topics or [])),
+                confstats.recordChangeAsync(None, conf)]
+        for rpc in rpcs:
+            rpc.get_result()
+
+
+    @staticmethod
+    def _indexLater(keys, transactional=True):
+        """Enqueue search indexing of keys in the current transaction; return the RPC."""
+        return dispatch.enqueueAsync('/tasks/index_search',
+            params={'key': [key.urlsafe() for key in keys]},
+            transactional=transactional)
+
+
+    @staticmethod
+    def _putImported(entities):
+        """Put imported entities in batches, queueing an index task per batch.
+
+        Batches commit one by one, so each batch's task is enqueued once
+        its put has committed; an import that fails partway still gets
+        the batches it wrote indexed.
+        """
+        for start in range(0, len(entities), IMPORT_BATCH_SIZE):
+            batch = entities[start:start + IMPORT_BATCH_SIZE]
+            ndb.put_multi(batch)
+            ConferenceApi._indexLater([entity.key for entity in batch],
+                                      transactional=False).get_result()
+
+
     @ndb.transactional()
     def _updateConferenceObject(self, request):
         """Update Conference Object, return _copyConferenceToForm."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = identity.current().userId
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
@@ -229,6 +360,13 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # a rename has to be copied onto the conference's sessions
+        if request.name and request.name != conf.name:
+            dispatch.enqueue('/tasks/sync_session_names',
+                params={'conferenceKey': request.websafeConferenceKey},
+                transactional=True)
+        old = confstats.snapshot(conf)
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
@@ -242,7 +380,11 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
+        rpcs = [conf.put_async(), ConferenceApi._indexLater([conf.key]),
+                confstats.recordChangeAsync(old, conf)]
+        for rpc in rpcs:
+            if rpc:
+                rpc.get_result()
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
@@ -260,7 +402,19 @@ class ConferenceApi(remote.Service):
             http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        cf = self._updateConferenceObject(request)
+        cache.invalidate(ndb.Key(urlsafe=request.websafeConferenceKey))
+        confstats.wakeWorker()
+        # an explicit seat count replaces whatever the shards held
+        if request.seatsAvailable is not None:
+            seats.initSeats(ndb.Key(urlsafe=request.websafeConferenceKey),
+                request.seatsAvailable)
+            cf.seatsAvailable = request.seatsAvailable
+        # seats or name may have changed; keep the announcement in step
+        self._updateAnnouncement(ndb.Key(urlsafe=request.websafeConferenceKey),
+            cf.name, cf.seatsAvailable)
+        self._bumpSchedule(ndb.Key(urlsafe=request.websafeConferenceKey))
+        return cf
 
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
@@ -268,12 +422,13 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        # get Conference object and its organiser in one cached lookup;
+        # bail if not found
+        confKey = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf, prof = cache.getMulti([confKey, confKey.parent()])
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
         # return ConferenceForm
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
@@ -285,44 +440,138 @@ class ConferenceApi(remote.Service):
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id =  getUserId(user)
+        ident = identity.current()
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = Conference.query(ancestor=ident.profileKey).fetch()
+        prof = ident.getProfile()
+        seatCounts = seats.getSeatsAvailable(confs)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
             items=[self._copyConferenceToForm(conf, 
-                getattr(prof, 'displayName')) for conf in confs]
+                getattr(prof, 'displayName'), seatCounts[conf.key]) for conf in confs]
         )
 
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+    def _pageSize(self, request):
+        """Validate request.pageSize; return it or the default."""
+        pageSize = request.pageSize or DEFAULT_PAGE_SIZE
+        if pageSize < 1 or pageSize > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d." % MAX_PAGE_SIZE)
+        return pageSize
+
+
+    def _pageArgs(self, request):
+        """Validate request.pageSize/pageToken; return (pageSize, cursor)."""
+        return self._pageSize(request), self._pageCursor(request)
+
+
+    def _pageCursor(self, request):
+        """Validate request.pageToken; return its cursor or None."""
+        if not request.pageToken:
+            return None
+        try:
+            return ndb.Cursor(urlsafe=request.pageToken)
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+
+
+    def _fetchPage(self, query, request, **options):
+        """Fetch one page of query; return (entities, nextPageToken)."""
+        pageSize, cursor = self._pageArgs(request)
+        entities, nextCursor, more = query.fetch_page(pageSize,
+            start_cursor=cursor, **options)
+        nextPageToken = None
+        if more and nextCursor:
+            nextPageToken = nextCursor.urlsafe()
+        return entities, nextPageToken
+
+
+    @ndb.tasklet
+    def _copyConferencesToFormsAsync(self, conferences):
+        """Return ConferenceForm list, fetching organiser profiles in one batch."""
+        # need to fetch organiser displayName from profiles
+        # start the batched organiser lookup, count seats while it runs
+        organisers = list(set(ndb.Key(Profile, conf.organizerUserId)
+                              for conf in conferences))
+        profilesFuture = cache.getMultiAsync(organisers)
+        seatCounts = seats.getSeatsAvailable(conferences)
+        profiles = yield profilesFuture
+
+        # put display names in a dict for easier fetching
+        names = {}
+        for profile in profiles:
+            if profile:
+                names[profile.key.id()] = profile.displayName
+
+        # return individual ConferenceForm object per Conference
+        raise ndb.Return([self._copyConferenceToForm(conf,
+                              names.get(conf.organizerUserId), seatCounts[conf.key])
+                          for conf in conferences])
 
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
 
+    def _copyConferencesToForms(self, conferences):
+        """Return ConferenceForm list, fetching organiser profiles in one batch."""
+        return self._copyConferencesToFormsAsync(conferences).get_result()
+
+
+    def _matchConferenceKeys(self, filters):
+        """Return the set of Conference keys matching filters, or None if no filters.
+
+        Equality filters run as one query, which datastore answers by
+        zig-zag merging built-in single-property indexes; each field with
+        an inequality gets its own keys-only range scan. The scans run
+        concurrently and their key sets are intersected here, so no
+        composite indexes are needed whatever the filter combination.
+        """
+        equalities = [filtr for filtr in filters if filtr["operator"] == "="]
+        ranges = {}
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+            if filtr["operator"] != "=":
+                ranges.setdefault(filtr["field"], []).append(filtr)
+
+        queries = []
+        for group in [equalities] + ranges.values():
+            if group:
+                q = Conference.query()
+                for filtr in group:
+                    q = q.filter(ndb.query.FilterNode(
+                        filtr["field"], filtr["operator"], filtr["value"]))
+                queries.append(q)
+        if not queries:
+            return None
+
+        futures = [q.fetch_async(keys_only=True) for q in queries]
+        return set.intersection(*[set(f.get_result()) for f in futures])
+
+
+    def _runConferencePlan(self, plan, filters):
+        """Return the conferences matching filters, run as planned by confstats."""
+        if plan['strategy'] == 'intersect':
+            return [conf for conf in cache.getMulti(self._matchConferenceKeys(filters))
+                    if conf]
+
+        # residual/keysOnlyHydrate: datastore evaluates the driving field only
+        q = Conference.query()
+        residual = []
+        for filtr in filters:
+            if filtr["field"] == plan['drivingField']:
+                q = q.filter(ndb.query.FilterNode(
+                    filtr["field"], filtr["operator"], filtr["value"]))
+            else:
+                residual.append(filtr)
+        if plan['strategy'] == 'keysOnlyHydrate':
+            conferences = cache.getMulti(q.fetch(keys_only=True))
+        else:
+            conferences = q.fetch()
+        return [conf for conf in conferences if conf and
+                all(confstats.matches(conf, filtr) for filtr in residual)]
 
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
-        inequality_field = None
+        inequality_fields = []
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
@@ -333,18 +582,20 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException("Filter value must be a number.")
+
+            # Every operation except "=" is an inequality; any number of
+            # fields may have one, as each field is scanned on its own index
+            # track the fields on which inequality operations are performed
+            if filtr["operator"] != "=" and filtr["field"] not in inequality_fields:
+                inequality_fields.append(filtr["field"])
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return (inequality_fields, formatted_filters)
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
@@ -353,109 +604,357 @@ class ConferenceApi(remote.Service):
             name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
+        inequality_fields, filters = self._formatFilters(request.filters)
+        plan = confstats.plan(filters)
+        if plan['strategy'] == 'scan':
+            conferences = Conference.query().order(Conference.name).fetch()
+        else:
+            conferences = self._runConferencePlan(plan, filters)
+            # If exists, sort on the (single) inequality field first
+            if len(inequality_fields) == 1:
+                field = inequality_fields[0]
+                conferences.sort(key=lambda conf: (getattr(conf, field), conf.name))
+            else:
+                conferences.sort(key=lambda conf: conf.name)
+        return ConferenceForms(items=self._copyConferencesToForms(conferences))
 
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+    @endpoints.method(ConferenceQueryForms, QueryPlanForm,
+            path='explainConferenceQuery',
+            http_method='POST',
+            name='explainConferenceQuery')
+    def explainConferenceQuery(self, request):
+        """Return the plan & estimated cost queryConferences would use."""
+        _, filters = self._formatFilters(request.filters)
+        plan = confstats.plan(filters)
+        return QueryPlanForm(
+            strategy=plan['strategy'],
+            datastoreFilters=plan['datastoreFilters'],
+            residualFilters=plan['residualFilters'],
+            estimatedRows=plan['estimatedRows'],
+            estimatedCost=plan['estimatedCost'])
+
+
+    @endpoints.method(CONF_QUERY_PAGE_REQUEST, ConferenceForms,
+            path='queryConferencesPaged',
+            http_method='POST',
+            name='queryConferencesPaged')
+    def queryConferencesPaged(self, request):
+        """Query for conferences, one page at a time.
+
+        Unfiltered pages are in name order. Filtered pages follow the index
+        of the planner's driving field and may be short (see
+        _runConferencePage); keep paging while nextPageToken is set.
+        """
+        pageSize, cursor = self._pageArgs(request)
+        _, filters = self._formatFilters(request.filters)
+        if filters:
+            conferences, nextCursor = self._runConferencePage(
+                filters, pageSize, cursor)
+        else:
+            keys, nextCursor, more = Conference.query().order(
+                Conference.name).fetch_page(pageSize, keys_only=True,
+                start_cursor=cursor)
+            conferences = [conf for conf in cache.getMulti(keys) if conf]
+            if not more:
+                nextCursor = None
 
-        # return individual ConferenceForm object per Conference
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in conferences]
-        )
+            items=self._copyConferencesToForms(conferences),
+            nextPageToken=nextCursor.urlsafe() if nextCursor else None)
+
+
+    def _runConferencePage(self, filters, pageSize, cursor):
+        """Return (conferences, nextCursor) for one page of filtered conferences.
+
+        Only filters on one field are queried, keys-only; keys are
+        hydrated through the entity cache a batch at a time and checked
+        against the remaining filters. != is never sent (ndb runs it as
+        two merged queries, which can't be paged with a cursor), so with
+        only != filters conferences are walked in key order. At most
+        CONFERENCE_QUERY_SCAN_LIMIT keys are read per page, so a sparse
+        match may return a short page with a cursor to continue from.
+        """
+        pushable = [filtr["field"] for filtr in filters
+                    if filtr["operator"] != "!="]
+        driving = confstats.plan(filters)['drivingField']
+        if driving not in pushable:
+            driving = pushable[0] if pushable else None
+        if driving is None:
+            q = Conference.query().order(Conference.key)
+        else:
+            q = Conference.query()
+        residual = []
+        for filtr in filters:
+            if filtr["field"] == driving and filtr["operator"] != "!=":
+                q = q.filter(ndb.query.FilterNode(
+                    filtr["field"], filtr["operator"], filtr["value"]))
+            else:
+                residual.append(filtr)
+
+        it = q.iter(keys_only=True, start_cursor=cursor, produce_cursors=True,
+            batch_size=MAX_PAGE_SIZE)
+        keyCursors = ((key, it.cursor_after()) for key in it)
+        conferences = []
+        scanned = 0
+        while scanned < CONFERENCE_QUERY_SCAN_LIMIT:
+            batch = list(itertools.islice(keyCursors,
+                min(MAX_PAGE_SIZE, CONFERENCE_QUERY_SCAN_LIMIT - scanned)))
+            if not batch:
+                return conferences, None
+            scanned += len(batch)
+            confs = cache.getMulti([key for key, _ in batch])
+            for (key, keyCursor), conf in zip(batch, confs):
+                if conf and all(confstats.matches(conf, filtr)
+                                for filtr in residual):
+                    conferences.append(conf)
+                    if len(conferences) >= pageSize:
+                        return conferences, keyCursor
+        return conferences, batch[-1][1]
 
 
 #----speaker
 
     def _copySpeakerToForm(self, speaker):
         """Check for speaker info, return speakerForm with speaker information."""
-        sf = SpeakerForm()
-        for field in sf.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(sf, field.name, getattr(speaker, field.name))
-            elif field.name == 'websafeKey':
-                setattr(sf, field.name, speaker.key.urlsafe())
-        sf.check_initialized()
-        return sf
+        return SPEAKER_CONVERTER.convert(speaker)
 
     @endpoints.method(SpeakerForm, SpeakerForm, path='speakers/add', http_method='POST', name='addSpeaker')
     def addSpeaker(self, request):
-        """Get profile from user, take field info for all fields, give key and put into datastore"""
-        prof=self._getProfileFromUser()
+        """Take field info for all fields, give key and put into datastore"""
+        identity.current().requireUser()
         data={field.name:getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
-        speaker=Speaker(**data)
-        speaker.put()
+        first, _ = Speaker.allocate_ids(size=1)
+        speaker=Speaker(key=ndb.Key(Speaker, first), **data)
+        self._commitSpeaker(speaker)
+        cache.invalidate(speaker.key)
         return self._copySpeakerToForm(speaker)
 
+    @staticmethod
+    @ndb.transactional()
+    def _commitSpeaker(speaker):
+        """Put a new speaker together with its indexing task."""
+        for rpc in [speaker.put_async(), ConferenceApi._indexLater([speaker.key])]:
+            rpc.get_result()
+
+    @endpoints.method(ImportSpeakersForm, ImportResultForms, path='speakers/import', http_method='POST', name='importSpeakers')
+    def importSpeakers(self, request):
+        """Create many speakers at once; errors are reported per row."""
+        identity.current().requireUser()
+        rows = self._importRows(request.speakers, request.csv)
+        results = [ImportRowResult(row=i) for i in range(len(rows))]
+        valid = []
+        for i, fields in enumerate(rows):
+            if not fields.get('speakerName'):
+                results[i].error = "Speaker 'speakerName' field required."
+                continue
+            valid.append((i, dict((name, fields.get(name)) for name in
+                ('speakerName', 'speakerInfo', 'speakerContact'))))
+        if not valid:
+            return ImportResultForms(items=results, imported=0)
+
+        first, _ = Speaker.allocate_ids(size=len(valid))
+        speakers = []
+        for n, (i, data) in enumerate(valid):
+            speaker = Speaker(key=ndb.Key(Speaker, first + n), **data)
+            speakers.append(speaker)
+            results[i].websafeKey = speaker.key.urlsafe()
+        self._putImported(speakers)
+        return ImportResultForms(items=results, imported=len(speakers))
+
     @endpoints.method(message_types.VoidMessage, SpeakerForms, path = 'speakers/get', http_method = 'GET', name = 'getSpeakers')
     def getSpeakers(self, request):
         """Query datastore for all speakers."""
         speakers = Speaker.query()
+        return SpeakerForms(items = SPEAKER_CONVERTER.convertAll(speakers))
+
+    @endpoints.method(PAGE_REQUEST, SpeakerForms, path = 'speakers/getPaged', http_method = 'GET', name = 'getSpeakersPaged')
+    def getSpeakersPaged(self, request):
+        """Query datastore for speakers, one page at a time."""
+        speakers, nextPageToken = self._fetchPage(
+            Speaker.query().order(Speaker.key), request)
         return SpeakerForms(
-            items = [self._copySpeakerToForm(speaker)
-            for speaker in speakers]
+            items = SPEAKER_CONVERTER.convertAll(speakers),
+            nextPageToken = nextPageToken
             )
 
     @endpoints.method(CONF_GET_REQUEST, SpeakerForms, path='speakers/getSpeakersByConf/{websafeConferenceKey}', http_method='GET', name='getSpeakersByConf')
     def getSpeakersByConf(self, request):
         """Populate all speakers for a given conference key."""
         confKey = ndb.Key(urlsafe=request.websafeConferenceKey)
-        sessions = Session.query(ancestor = confKey, projection = ["speakerKey"], distinct = True)
-        speakerKeys = [(ndb.Key(urlsafe = sess.speakerKey)) for sess in sessions]
-        confSpeakers = ndb.get_multi(speakerKeys)
-        return SpeakerForms(
-            items = [self._copySpeakerToForm(confSpeaker)
-            for confSpeaker in confSpeakers
-            ]
-            )
+        roster = self._getRoster(confKey)
+        confSpeakers = cache.getMulti(roster.speakerKeys)
+        return SpeakerForms(items = SPEAKER_CONVERTER.convertAll(confSpeakers))
+
+
+# - - - Schedule - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _versionBase():
+        """Return a schedule version later than any handed out before now."""
+        return calendar.timegm(datetime.utcnow().utctimetuple()) * 1000
+
+
+    @staticmethod
+    def _scheduleVersion(confKey):
+        """Return the current schedule version of a conference."""
+        versionKey = MEMCACHE_SCHEDULE_VERSION_KEY % confKey.urlsafe()
+        version = memcache.get(versionKey)
+        if version is None:
+            # an evicted counter restarts from the clock, so old etags
+            # can't match the new versions
+            memcache.add(versionKey, ConferenceApi._versionBase())
+            version = memcache.get(versionKey) or ConferenceApi._versionBase()
+        return version
 
 
+    @staticmethod
+    def _bumpSchedule(*confKeys):
+        """Move conferences to a new schedule version after writing to them."""
+        if confKeys:
+            memcache.offset_multi(
+                dict((MEMCACHE_SCHEDULE_VERSION_KEY % key.urlsafe(), 1)
+                     for key in set(confKeys)),
+                initial_value=ConferenceApi._versionBase())
+
+
+    @ndb.tasklet
+    def _buildScheduleAsync(self, confKey):
+        """Return a ScheduleForm for confKey (None if no such conference),
+        without etag or registration state."""
+        # the session query, conference/organiser and roster are independent
+        sessions, (conf, organizer), roster = yield (
+            Session.query(ancestor=confKey).fetch_async(),
+            cache.getMultiAsync([confKey, confKey.parent()]),
+            self._rosterKey(confKey).get_async())
+        if not conf:
+            raise ndb.Return(None)
+        if not roster or roster.sessionCounts is None:
+            roster = self._buildRoster(confKey)
+
+        sessions.sort(key=lambda sess: (sess.startDate, sess.startTime))
+        sessionForms, speakers = yield (self._hydrateSessionsAsync(sessions),
+            cache.getMultiAsync(roster.speakerKeys))
+        days = []
+        for date, dayForms in itertools.groupby(
+                sessionForms, lambda form: form.startDate):
+            days.append(ScheduleDayForm(date=date, slots=[
+                ScheduleSlotForm(startTime=startTime, sessions=list(slotForms))
+                for startTime, slotForms in itertools.groupby(
+                    dayForms, lambda form: form.startTime)]))
+        raise ndb.Return(ScheduleForm(
+            conference=self._copyConferenceToForm(conf,
+                getattr(organizer, 'displayName', None)),
+            days=days,
+            speakers=SPEAKER_CONVERTER.convertAll(speakers)))
+
+
+    @endpoints.method(SCHEDULE_GET_REQUEST, ScheduleForm,
+            path='conference/{websafeConferenceKey}/schedule',
+            http_method='GET', name='getConferenceSchedule')
+    def getConferenceSchedule(self, request):
+        """Return a conference with its sessions by day & time and its speakers.
+
+        Send a previous response's etag as ifNoneMatch (or If-None-Match)
+        to get back just notModified if nothing has changed since.
+        """
+        wsck = request.websafeConferenceKey
+        confKey = ndb.Key(urlsafe=wsck)
+        etag = '"%d"' % self._scheduleVersion(confKey)
+        headers = getattr(self.request_state, 'headers', None) or {}
+        if etag in (request.ifNoneMatch, headers.get('If-None-Match')):
+            return ScheduleForm(etag=etag, notModified=True)
+
+        # snapshots are keyed by version, so a bump retires them
+        snapshotKey = MEMCACHE_SCHEDULE_KEY % (wsck, etag)
+        snapshot = memcache.get(snapshotKey)
+        if snapshot:
+            schedule = protojson.decode_message(ScheduleForm, snapshot)
+        else:
+            schedule = self._buildScheduleAsync(confKey).get_result()
+            if not schedule:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % wsck)
+            schedule.etag = etag
+            memcache.set(snapshotKey, protojson.encode_message(schedule),
+                time=SCHEDULE_CACHE_TTL)
+
+        # per user, and any registration change bumps the version anyway
+        ident = identity.current()
+        if ident.user:
+            schedule.registered = self._registrationKey(
+                ident.profileKey, wsck).get() is not None
+        return schedule
+
+
+# - - - Search - - - - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(SearchForm, SearchResultForms, path='search',
+            http_method='POST', name='search')
+    def search(self, request):
+        """Keyword search over conferences, sessions & speakers; last word matches as a prefix."""
+        pageSize = self._pageSize(request)
+        kinds = request.kinds or None
+        if kinds and set(kinds) - set(textsearch.INDEXED_FIELDS):
+            raise endpoints.BadRequestException(
+                "kinds must be among: %s" % ', '.join(sorted(textsearch.INDEXED_FIELDS)))
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+
+        hits = textsearch.search(request.query, kinds)
+        page = hits[offset:offset + pageSize]
+        entities = cache.getMulti([key for key, _ in page])
+        items = []
+        for (key, score), entity in zip(page, entities):
+            if not entity:
+                continue
+            items.append(SearchResultForm(kind=key.kind(),
+                websafeKey=key.urlsafe(), score=score,
+                title=getattr(entity, {'Conference': 'name',
+                    'Session': 'session_name',
+                    'Speaker': 'speakerName'}[key.kind()])))
+        nextPageToken = None
+        if offset + pageSize < len(hits):
+            nextPageToken = str(offset + pageSize)
+        return SearchResultForms(items=items, nextPageToken=nextPageToken)
+
+
+    @staticmethod
+    def _reindexSearch(kind, cursor=None):
+        """Index one batch of entities of kind; return next cursor or None."""
+        model = {'Conference': Conference, 'Session': Session,
+                 'Speaker': Speaker}[kind]
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        entities, nextCursor, more = model.query().fetch_page(
+            SESSION_BATCH_SIZE, start_cursor=cursor)
+        textsearch.indexEntities(entities)
+        if more and nextCursor:
+            return nextCursor.urlsafe()
+        return None
+
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
-    def _copyProfileToForm(self, prof):
+    def _copyProfileToForm(self, prof, sessionWishlist=None):
         """Copy relevant fields from Profile to ProfileForm."""
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        # t-shirt string is converted to Enum by the converter
+        if sessionWishlist is None:
+            sessionWishlist = [key.id() for key in WishlistEntry.query(
+                ancestor=prof.key).fetch(keys_only=True)]
+        return PROFILE_CONVERTER.convert(prof, sessionWishlist=sessionWishlist)
 
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
-        if not profile:
-            profile = Profile(
-                key = p_key,
-                displayName = user.nickname(),
-                mainEmail= user.email(),
-                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
-
-        return profile      # return Profile
+        # resolved once per request, see identity.py
+        prof = identity.current().getProfile()
+        if prof.sessionWishlist or prof.conferenceKeysToAttend:
+            prof = self._migrateProfileLists(prof.key)
+            identity.profileWritten(prof.key)
+        return prof
 
 
     def _doProfile(self, save_request=None):
@@ -474,6 +973,7 @@ class ConferenceApi(remote.Service):
                         #else:
                         #    setattr(prof, field, val)
             prof.put()
+            identity.profileWritten(prof.key)
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -494,72 +994,269 @@ class ConferenceApi(remote.Service):
 
 #-----session
 
+    @staticmethod
+    def _getSpeakerKey(sess):
+        """Return the session's speaker Key, including not yet migrated sessions."""
+        if sess.speakerKey:
+            return sess.speakerKey
+        if sess.legacySpeakerKey:
+            return ndb.Key(urlsafe=sess.legacySpeakerKey)
+        return None
+
+    @staticmethod
+    def _speakerSessionsQuery(speakerKey, ancestor=None):
+        """Return a query for the speaker's sessions, migrated or not.
+
+        Sessions not yet moved off the string speakerKey are matched on
+        it; the key order lets ndb page the merged OR query by cursor.
+        """
+        return Session.query(ndb.OR(Session.speakerKey == speakerKey,
+                                    Session.legacySpeakerKey == speakerKey.urlsafe()),
+                             ancestor=ancestor).order(Session.key)
+
+    @staticmethod
+    def _rosterKey(confKey):
+        """Return the ConferenceSpeakers key for a conference."""
+        return ndb.Key(ConferenceSpeakers, 'speakers', parent=confKey)
+
+    @staticmethod
+    def _countSession(roster, speakerKey):
+        """Count one more session for speakerKey on roster (not saved)."""
+        if speakerKey not in roster.speakerKeys:
+            roster.speakerKeys.append(speakerKey)
+        wssk = speakerKey.urlsafe()
+        count = roster.sessionCounts.get(wssk, 0) + 1
+        roster.sessionCounts[wssk] = count
+        # featured speaker: the one with most sessions, needing at least two
+        featured = roster.featuredSpeakerKey
+        if count > 1 and (not featured or
+                count > roster.sessionCounts.get(featured.urlsafe(), 0)):
+            roster.featuredSpeakerKey = speakerKey
+
+    @staticmethod
+    @ndb.transactional()
+    def _buildRoster(confKey):
+        """Create the conference's speaker roster & counts from its sessions."""
+        roster = ConferenceSpeakers(key=ConferenceApi._rosterKey(confKey),
+            speakerKeys=[], sessionCounts={})
+        for sess in Session.query(ancestor=confKey):
+            speakerKey = ConferenceApi._getSpeakerKey(sess)
+            if speakerKey:
+                ConferenceApi._countSession(roster, speakerKey)
+        roster.put()
+        return roster
+
+    @staticmethod
+    def _getRoster(confKey):
+        """Return the conference roster, building it if missing or uncounted."""
+        roster = ConferenceApi._rosterKey(confKey).get()
+        if not roster or roster.sessionCounts is None:
+            # conference predates the roster/counters; build once from sessions
+            roster = ConferenceApi._buildRoster(confKey)
+        return roster
+
+    @ndb.transactional()
+    def _saveSession(self, session):
+        """Put session, count it on the conference roster and queue its indexing.
+
+        The conference name is copied onto the session here, from a read in
+        this transaction, so a rename committed after createSession looked
+        at the conference can't leave the session with the old name.
+        """
+        confFuture = session.key.parent().get_async()
+        roster = self._getRoster(session.key.parent())
+        session.conferenceName = confFuture.get_result().name
+        toPut = [session]
+        if session.speakerKey:
+            self._countSession(roster, session.speakerKey)
+            toPut.append(roster)
+        for rpc in ndb.put_multi_async(toPut) + [self._indexLater([session.key])]:
+            rpc.get_result()
+
     def _copySessionToForm(self, sess, conferenceName, speakerName):
         """Returns session form given user input."""
-        session = SessionForm()
-        for field in session.all_fields():
-            if hasattr(sess, field.name):
-                if field.name.endswith('Date'):
-                    setattr(session, field.name,str(getattr(sess, field.name)))
-                elif field.name.endswith('Time'):
-                    setattr(session, field.name, str(getattr(sess, field.name)))
-                elif field.name.endswith('uration'):
-                    setattr(session, field.name, getattr(sess, field.name))
-                else:
-                    setattr(session, field.name, str(getattr(sess, field.name)))
-            elif field.name == "websafeSessionKey":
-                setattr(session, field.name, sess.key.urlsafe())
+        session = SESSION_CONVERTER.convert(sess)
+        if not sess.speakerKey and sess.legacySpeakerKey:
+            session.speakerKey = sess.legacySpeakerKey
         if conferenceName:
-            setattr(session, 'conferenceName', conferenceName)
+            session.conferenceName = conferenceName
         if speakerName:
-            setattr(session, 'speakerName', speakerName)
-        session.check_initialized()
+            session.speakerName = speakerName
         return session
 
+    @ndb.tasklet
+    def _hydrateSessionAsync(self, sess):
+        """Return the SessionForm for sess, fetching names it lacks."""
+        # names are denormalized onto Session; only sessions written before
+        # that (and not yet backfilled) need their speaker/conference fetched.
+        # Lookups from sessions hydrated side by side are auto-batched.
+        keys = []
+        if not sess.conferenceName:
+            keys.append(sess.key.parent())
+        speakerKey = self._getSpeakerKey(sess)
+        if speakerKey and not sess.speakerName:
+            keys.append(speakerKey)
+        entities = {}
+        if keys:
+            entities = dict(zip(keys, (yield cache.getMultiAsync(keys))))
+        raise ndb.Return(self._copySessionToForm(sess,
+            getattr(entities.get(sess.key.parent()), 'name', None),
+            getattr(entities.get(speakerKey), 'speakerName', None)))
+
+
+    @ndb.tasklet
+    def _hydrateSessionsAsync(self, sessions):
+        """Return SessionForm list for sessions (a list or a query).
+
+        A query is consumed with map_async, so name lookups for one batch
+        of results overlap fetching the next.
+        """
+        if isinstance(sessions, ndb.Query):
+            forms = yield sessions.map_async(self._hydrateSessionAsync)
+        else:
+            forms = yield [self._hydrateSessionAsync(sess)
+                           for sess in sessions if sess]
+        raise ndb.Return(forms)
+
+
+    def _hydrateSessions(self, sessions):
+        """Return SessionForm list for sessions, batch-fetching speakers & conferences."""
+        return self._hydrateSessionsAsync(sessions).get_result()
+
     @endpoints.method(SESSION_CREATE, SessionForm, path='session', http_method='POST', name='createSession')
     def createSession(self, request):
         """Create session."""
         #check for conference key/confirm user is person who created conference.
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException("Need authorization")
-        user_id = getUserId(user)
+        user_id = identity.current().userId
         confKey = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # the session ID is allocated while the request is checked
+        idFuture = Session.allocate_ids_async(size=1, parent=confKey)
         conf = confKey.get()
         if not conf:
             raise endpoints.BadRequestException("No conference found.")
 
         if user_id != conf.organizerUserId:
             raise endpoints.ForbiddenException("Only owner can add sessions.")
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        data = self._sessionData(
+            {field.name: getattr(request, field.name) for field in request.all_fields()})
+
+        # store display names on the session so listings need no joins;
+        # _saveSession adds the conference name
+        if data['speakerKey']:
+            speaker = cache.get(data['speakerKey'])
+            if not speaker:
+                raise endpoints.BadRequestException("No speaker found.")
+            data['speakerName'] = speaker.speakerName
+            #give session key with conference key as parent. allows speaker to be set via speaker key
+        s_key = ndb.Key(Session, idFuture.get_result()[0], parent=confKey)
+        data['key'] = s_key
+        session = Session(**data)
+        self._saveSession(session)
+        self._bumpSchedule(confKey)
+        # a burst of new sessions for one conference shares one recompute
+        dispatch.enqueueCoalesced('/tasks/set_speaker', request.websafeConferenceKey,
+            params={'conferenceKey': request.websafeConferenceKey})
 
-        del data['websafeConferenceKey']
+        return self._copySessionToForm(session, "", "")
 
-        #check data/start time/duration fields, get values
+    def _sessionData(self, fields):
+        """Validate session fields; return them converted for Session(**data)."""
+        data = {}
+        for name in ('session_name', 'highlights', 'speakerKey', 'duration',
+                     'typeOfSession', 'startDate', 'startTime'):
+            data[name] = fields.get(name) or None
 
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
+        #check data/start time/duration fields, get values
+        try:
+            if data['startDate']:
+                data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
+            if data['startTime']:
+                data['startTime'] = datetime.strptime(data['startTime'][:10], "%H:%M").time()
+            data['duration'] = int(data['duration'] or 0)
+        except ValueError, e:
+            raise endpoints.BadRequestException(str(e))
         if not data['startDate']:
             raise endpoints.BadRequestException("Session 'start date' field required")
-        if data['startTime']:
-            data['startTime'] = datetime.strptime(data['startTime'][:10], "%H:%M").time()
         if not data['startTime']:
             raise endpoints.BadRequestException("Session 'start time' field required")
         if not data['session_name']:
             raise endpoints.BadRequestException("Session 'name' field required.")
-        else:
-            data['duration'] = 0
-            #give session key with conference key as parent. allows speaker to be set via speaker key
-        s_id = Session.allocate_ids(size = 1, parent=confKey)[0]
-        s_key = ndb.Key(Session, s_id, parent=confKey)
-        data['key'] = s_key
-        session = Session(**data)
-        session.put()
-        taskqueue.add(params={'speakerKey': request.speakerKey,
-         'conferenceKey': request.websafeConferenceKey}, 
-         url='/tasks/set_speaker')
+        if data['speakerKey']:
+            data['speakerKey'] = self._parseSpeakerKey(data['speakerKey'])
+        return data
+
+    def _importRows(self, messageRows, csvText):
+        """Return import rows as dicts, from messages or CSV text (header first)."""
+        if csvText:
+            reader = csv.DictReader(StringIO(csvText.encode('utf-8')))
+            return [dict((name, value.decode('utf-8'))
+                         for name, value in row.items() if name and value)
+                    for row in reader]
+        return [dict((field.name, getattr(msg, field.name))
+                     for field in msg.all_fields()) for msg in messageRows]
+
+    @endpoints.method(ImportSessionsForm, ImportResultForms,
+        path='session/import', http_method='POST', name='importSessions')
+    def importSessions(self, request):
+        """Create many sessions for a conference; errors are reported per row."""
+        user_id = identity.current().userId
+        confKey = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf = cache.get(confKey)
+        if not conf:
+            raise endpoints.BadRequestException("No conference found.")
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException("Only owner can add sessions.")
 
-        return self._copySessionToForm(session, "", "")
+        # validate every row up front
+        rows = self._importRows(request.sessions, request.csv)
+        results = [ImportRowResult(row=i) for i in range(len(rows))]
+        valid = []
+        for i, fields in enumerate(rows):
+            try:
+                valid.append((i, self._sessionData(fields)))
+            except endpoints.BadRequestException, e:
+                results[i].error = str(e)
+
+        # resolve all speakers with one batch lookup
+        speakerKeys = list(set(data['speakerKey'] for _, data in valid
+                               if data['speakerKey']))
+        speakers = dict(zip(speakerKeys, cache.getMulti(speakerKeys)))
+        sessionsData = []
+        for i, data in valid:
+            if data['speakerKey']:
+                speaker = speakers.get(data['speakerKey'])
+                if not speaker:
+                    results[i].error = "No speaker found."
+                    continue
+                data['speakerName'] = speaker.speakerName
+            data['conferenceName'] = conf.name
+            sessionsData.append((i, data))
+        if not sessionsData:
+            return ImportResultForms(items=results, imported=0)
+
+        # one id allocation, chunked batch writes
+        first, _ = Session.allocate_ids(size=len(sessionsData), parent=confKey)
+        sessions = []
+        for n, (i, data) in enumerate(sessionsData):
+            session = Session(key=ndb.Key(Session, first + n, parent=confKey), **data)
+            sessions.append(session)
+            results[i].websafeKey = session.key.urlsafe()
+        self._putImported(sessions)
+        self._countSessions(confKey, [s.speakerKey for s in sessions if s.speakerKey])
+        self._bumpSchedule(confKey)
+        dispatch.enqueueCoalesced('/tasks/set_speaker', request.websafeConferenceKey,
+            params={'conferenceKey': request.websafeConferenceKey})
+
+        return ImportResultForms(items=results, imported=len(sessions))
+
+    @staticmethod
+    @ndb.transactional()
+    def _countSessions(confKey, speakerKeys):
+        """Count already written sessions (by speaker key) on the roster."""
+        roster = ConferenceApi._getRoster(confKey)
+        for speakerKey in speakerKeys:
+            ConferenceApi._countSession(roster, speakerKey)
+        roster.put()
 
     @endpoints.method(CONF_GET_REQUEST, SessionForms, 
         path='getConferenceSessions/{websafeConferenceKey}', 
@@ -569,10 +1266,20 @@ class ConferenceApi(remote.Service):
         """Query datastore for all sessions based on conference key."""
         confKey = ndb.Key(urlsafe=request.websafeConferenceKey)
         sessions = Session.query(ancestor=confKey)
-        conferenceName = confKey.get().name
+        return SessionForms(items=self._hydrateSessions(sessions))
+
+    @endpoints.method(CONF_PAGE_REQUEST, SessionForms,
+        path='getConferenceSessionsPaged/{websafeConferenceKey}',
+        http_method = 'GET',
+        name='getConferenceSessionsPaged')
+    def getConferenceSessionsPaged(self, request):
+        """Query sessions for a conference key, one page at a time."""
+        confKey = ndb.Key(urlsafe=request.websafeConferenceKey)
+        sessions, nextPageToken = self._fetchPage(
+            Session.query(ancestor=confKey).order(Session.key), request)
         return SessionForms(
-            items=[self._copySessionToForm(sess, conferenceName, 
-                ndb.Key(urlsafe=sess.speakerKey).get().speakerName) for sess in sessions])
+            items=self._hydrateSessions(sessions),
+            nextPageToken=nextPageToken)
 
     @endpoints.method(SESSION_TYPE_GET_REQUEST, SessionForms, 
         path='getConferenceSessionsByType/{websafeConferenceKey}/{typeOfSession}', 
@@ -582,10 +1289,7 @@ class ConferenceApi(remote.Service):
         """Given conference key, query sessions with filter for session type."""
         confKey = ndb.Key(urlsafe=request.websafeConferenceKey)
         sessions = Session.query(ancestor=confKey).filter(Session.typeOfSession == request.typeOfSession)
-        conferenceName = confKey.get().name
-        return SessionForms(items = [self._copySessionToForm(sess, conferenceName, 
-            ndb.Key(urlsafe = sess.speakerKey).get().speakerName) for sess in sessions]
-            )
+        return SessionForms(items=self._hydrateSessions(sessions))
 
     @endpoints.method(SESSION_SPEAKER_GET_REQUEST, SessionForms, 
         path='getSessionsBySpeaker/{speakerKey}', 
@@ -593,12 +1297,9 @@ class ConferenceApi(remote.Service):
         name='getSessionsBySpeaker')
     def getSessionsBySpeaker(self, request):
         """Query all sessions which speaker is in, given the speaker key."""
-        wssk = request.speakerKey
-        sessions = Session.query().filter(Session.speakerKey == wssk).fetch()
-        speaker = ndb.Key(urlsafe=wssk).get()
-        return SessionForms(
-            items = [self._copySessionToForm(sess, sess.key.parent().get().name, speaker.speakerName) for sess in sessions]
-            )
+        sessions = self._speakerSessionsQuery(
+            self._parseSpeakerKey(request.speakerKey)).fetch()
+        return SessionForms(items=self._hydrateSessions(sessions))
 
     @endpoints.method(
         SESSION_TIME_GET_REQUEST, SessionForms, 
@@ -608,34 +1309,209 @@ class ConferenceApi(remote.Service):
     def getSessionsByTime(self, request):
         """Query sessions return those with given start time."""
         sessions = Session.query()
-        startTime = datetime.strptime(request.startTime[:10], "%H:%M").time()
+        startTime = self._parseTime(request.startTime)
         sessions = sessions.filter(Session.startTime == startTime)
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
-            )
+        return SessionForms(items=self._hydrateSessions(sessions))
 
-    @endpoints.method(message_types.VoidMessage, 
+    @endpoints.method(PAGE_TOKEN_REQUEST, 
         SessionForms, 
         path='getWorkshopSessionBeforeSeven', 
         http_method='GET', 
         name='getWorkshopSessionBeforeSeven')
     def getWorkShopSessionBeforeSeven(self, request):
-        """Query sessions for all not workshop, before 7 PM."""
-        #query session by type not workshop
-        sessions = Session.query(Session.typeOfSession!= "workshop")
+        """Query sessions for all not workshop, before 7 PM.
+
+        At most WORKSHOP_QUERY_MAX_PAGES scan-limited pages are read per
+        call; if sessions remain, pass nextPageToken back for the rest.
+        """
+        #startTime < 19:00 (7PM) runs in datastore, type != workshop is checked per session
+        filters = [('typeOfSession', '!=', 'workshop'),
+                   ('startTime', '<', time(19, 0))]
         validSessions = []
-        #for all sessions in query, check time to see if it's before 19:00 (7PM)
-        for sess in sessions:
-            if sess.startTime < datetime.strptime("19:00", "%H:%M").time():
-                validSessions.append(sess)
+        cursor = self._pageCursor(request)
+        for _ in range(WORKSHOP_QUERY_MAX_PAGES):
+            sessions, cursor = self._runSessionQuery(filters, None,
+                MAX_PAGE_SIZE, cursor)
+            validSessions.extend(sessions)
+            if not cursor:
+                break
         #return all sessions fitting criteria
+        return SessionForms(items=self._hydrateSessions(validSessions),
+            nextPageToken=cursor.urlsafe() if cursor else None)
+
+    def _parseTime(self, value):
+        """Parse HH:MM into a time, or raise BadRequestException."""
+        try:
+            return datetime.strptime(value[:5], "%H:%M").time()
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid time: %s" % value)
+
+    def _parseDate(self, value):
+        """Parse YYYY-MM-DD into a date, or raise BadRequestException."""
+        try:
+            return datetime.strptime(value[:10], "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid date: %s" % value)
+
+    def _parseSpeakerKey(self, value):
+        """Parse a websafe Speaker key, or raise BadRequestException."""
+        try:
+            key = ndb.Key(urlsafe=value)
+        except Exception:
+            # malformed keys raise anything from TypeError to decode errors
+            raise endpoints.BadRequestException("Invalid speaker key.")
+        if key.kind() != 'Speaker':
+            raise endpoints.BadRequestException("Invalid speaker key.")
+        return key
+
+    def _formatSessionFilters(self, request):
+        """Turn a SessionQueryForm into (field, operator, value) filters."""
+        filters = []
+        if request.speakerKey:
+            filters.append(('speakerKey', '=', self._parseSpeakerKey(request.speakerKey)))
+        if request.typeOfSession:
+            filters.append(('typeOfSession', '=', request.typeOfSession))
+        if request.excludeTypeOfSession:
+            filters.append(('typeOfSession', '!=', request.excludeTypeOfSession))
+        if request.startTimeFrom:
+            filters.append(('startTime', '>=', self._parseTime(request.startTimeFrom)))
+        if request.startTimeBefore:
+            filters.append(('startTime', '<', self._parseTime(request.startTimeBefore)))
+        if request.startDateFrom:
+            filters.append(('startDate', '>=', self._parseDate(request.startDateFrom)))
+        if request.startDateTo:
+            filters.append(('startDate', '<=', self._parseDate(request.startDateTo)))
+        if request.minDuration is not None:
+            filters.append(('duration', '>=', request.minDuration))
+        if request.maxDuration is not None:
+            filters.append(('duration', '<=', request.maxDuration))
+        return filters
+
+    def _planSessionQuery(self, filters, ancestor):
+        """Split filters into (datastore query, residual filters).
+
+        Only filters on one field go to datastore, so every plan runs on
+        built-in single-property indexes. != is never sent (ndb runs it as
+        two merged queries, which can't be paged with a cursor), and with
+        an ancestor only equality is sent, as ancestor + inequality needs
+        a composite index.
+        """
+        pushable = [f for f in filters if f[1] != '!=' and
+                    (ancestor is None or f[1] == '=')]
+        pushed = []
+        for field in SESSION_FILTER_ORDER:
+            pushed = [f for f in pushable if f[0] == field]
+            if pushed:
+                break
+
+        if pushed and pushed[0][0] == 'speakerKey':
+            # one speaker equality filter, which has to match legacy sessions too
+            query = self._speakerSessionsQuery(pushed[0][2], ancestor)
+            pushed = pushed[:1]
+        else:
+            query = Session.query(ancestor=ancestor)
+            for field, op, value in pushed:
+                query = query.filter(COMPARISONS[op](getattr(Session, field), value))
+        residual = [f for f in filters if f not in pushed]
+        return query, residual
+
+    def _matchesSession(self, sess, residual):
+        """Return True if sess passes every residual filter."""
+        for field, op, value in residual:
+            if field == 'speakerKey':
+                actual = self._getSpeakerKey(sess)
+            else:
+                actual = getattr(sess, field)
+            # missing values never satisfy a filter
+            if actual is None or not COMPARISONS[op](actual, value):
+                return False
+        return True
+
+    def _runSessionQuery(self, filters, ancestor, pageSize, cursor):
+        """Return (sessions, nextCursor) for one page of a planned query.
+
+        Sessions stream in batches through the residual filters; at most
+        SESSION_QUERY_SCAN_LIMIT are read per page, so a sparse match may
+        return a short page with a cursor to continue from.
+        """
+        query, residual = self._planSessionQuery(filters, ancestor)
+        it = query.iter(start_cursor=cursor, produce_cursors=True,
+            batch_size=min(pageSize * 2, MAX_PAGE_SIZE))
+        sessions = []
+        scanned = 0
+        for sess in it:
+            scanned += 1
+            if self._matchesSession(sess, residual):
+                sessions.append(sess)
+            if len(sessions) >= pageSize or scanned >= SESSION_QUERY_SCAN_LIMIT:
+                break
+        if scanned and it.probably_has_next():
+            return sessions, it.cursor_after()
+        return sessions, None
+
+    @endpoints.method(SessionQueryForm, SessionForms,
+        path='querySessions',
+        http_method='POST',
+        name='querySessions')
+    def querySessions(self, request):
+        """Query sessions on any combination of type, time, date, duration & speaker."""
+        pageSize, cursor = self._pageArgs(request)
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = ndb.Key(urlsafe=request.websafeConferenceKey)
+
+        sessions, nextCursor = self._runSessionQuery(
+            self._formatSessionFilters(request), ancestor, pageSize, cursor)
         return SessionForms(
-            items=[self._copySessionToForm(sess, sess.key.parent().get().name, ndb.Key(urlsafe=sess.speakerKey).get().speakerName) for sess in validSessions]
-            )
+            items=self._hydrateSessions(sessions),
+            nextPageToken=nextCursor.urlsafe() if nextCursor else None)
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
+    @staticmethod
+    def _registrationKey(profKey, wsck):
+        """Return the key of profKey's Registration for conference wsck."""
+        return ndb.Key(Registration, wsck, parent=profKey)
+
+
+    @staticmethod
+    def _wishlistKey(profKey, wssk):
+        """Return the key of profKey's WishlistEntry for session wssk."""
+        return ndb.Key(WishlistEntry, wssk, parent=profKey)
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _setMember(key, member, **fields):
+        """Create/delete the child entity at key; return False if nothing changed."""
+        if member == (key.get() is not None):
+            return False
+        if member:
+            ndb.Model._lookup_model(key.kind())(key=key, **fields).put()
+        else:
+            key.delete()
+        return True
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _migrateProfileLists(profKey):
+        """Move a profile's legacy lists into child entities; return the profile."""
+        prof = profKey.get()
+        children = [Registration(
+                        key=ConferenceApi._registrationKey(profKey, wsck),
+                        conference=ndb.Key(urlsafe=wsck))
+                    for wsck in set(prof.conferenceKeysToAttend)]
+        children += [WishlistEntry(
+                         key=ConferenceApi._wishlistKey(profKey, wssk),
+                         session=ndb.Key(urlsafe=wssk))
+                     for wssk in set(prof.sessionWishlist)]
+        prof.conferenceKeysToAttend = []
+        prof.sessionWishlist = []
+        ndb.put_multi(children + [prof])
+        return prof
+
+
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
@@ -644,43 +1520,56 @@ class ConferenceApi(remote.Service):
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = cache.get(ndb.Key(urlsafe=wsck))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        # seats live in shards outside the conference entity group, so the
+        # seat and the profile are updated in separate small transactions
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if self._registrationKey(prof.key, wsck).get():
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
+            # take a seat from a random shard, if any are left
+            if not seats.reserveSeat(conf):
                 raise ConflictException(
                     "There are no seats available.")
 
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
+            # register user; give the seat back if that fails
+            try:
+                if not self._setMember(self._registrationKey(prof.key, wsck),
+                        True, conference=conf.key):
+                    raise ConflictException(
+                        "You have already registered for this conference")
+            except Exception:
+                seats.releaseSeat(conf)
+                raise
             retval = True
 
         # unregister
         else:
-            # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
-
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
-
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+            # unregister user if registered, add back one seat
+            retval = self._setMember(
+                self._registrationKey(prof.key, wsck), False)
+            if retval:
+                seats.releaseSeat(conf)
+
+        if retval:
+            self._bumpSchedule(conf.key)
+        if retval and prof.mainEmail:
+            notify.queueNotification('registered' if reg else 'unregistered',
+                prof.mainEmail, name=conf.name)
+
+        # seat counts move by one, so only conferences near the
+        # announcement window can enter or leave it
+        if retval:
+            seatsAvailable = seats.getSeatsAvailable([conf])[conf.key]
+            if seatsAvailable <= ANNOUNCEMENT_MAX_SEATS + 1:
+                self._updateAnnouncement(conf.key, conf.name, seatsAvailable)
         return BooleanMessage(data=retval)
 
 
@@ -691,22 +1580,49 @@ class ConferenceApi(remote.Service):
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.sessionWishlist]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        return ConferenceForms(
+            items=self._conferencesToAttendAsync(prof.key).get_result())
+
+
+    @ndb.tasklet
+    def _conferencesToAttendAsync(self, profKey):
+        """Return ConferenceForms for profKey's registrations."""
+        @ndb.tasklet
+        def fetch(registrationKey):
+            confs = yield cache.getMultiAsync([ndb.Key(urlsafe=registrationKey.id())])
+            raise ndb.Return(confs[0])
+
+        # conference lookups start as each batch of registrations arrives
+        conferences = yield Registration.query(ancestor=profKey).map_async(
+            fetch, keys_only=True)
+        forms = yield self._copyConferencesToFormsAsync(
+            [conf for conf in conferences if conf])
+        raise ndb.Return(forms)
+
+
+    @endpoints.method(CONF_PAGE_REQUEST, ProfileForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Return one page of a conference's attendees (organizer only)."""
+        confKey = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf = cache.get(confKey)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if identity.current().userId != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the organizer can list attendees.')
 
-        # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
-        )
+        # keys-only on the built-in index; each key's parent is the attendee
+        registrations, nextPageToken = self._fetchPage(
+            Registration.query(Registration.conference == confKey), request,
+            keys_only=True)
+        profiles = cache.getMulti([key.parent() for key in registrations])
+        return ProfileForms(
+            items=[self._copyProfileToForm(prof, sessionWishlist=[])
+                   for prof in profiles if prof],
+            nextPageToken=nextPageToken)
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
@@ -736,8 +1652,10 @@ class ConferenceApi(remote.Service):
         # TODO 1
         # return an existing announcement from Memcache or an empty string.
         announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ""
+        if announcement is None:
+            announcement = self._rebuildAnnouncement()
+        else:
+            _lastAnnouncement[0] = announcement
         return StringMessage(data=announcement)
 
 #---wishlist
@@ -747,28 +1665,26 @@ class ConferenceApi(remote.Service):
         boolvar = False
         prof = self._getProfileFromUser()
         sessionKey = request.sessionKey
-        session = ndb.Key(urlsafe=sessionKey).get()
+        entryKey = self._wishlistKey(prof.key, sessionKey)
 
         #if wishlist add and sessionkey doesn't exist, say no session found. if session key already in profile wishlist, say already exist. if new return boolvar true.
         if add:
+            session = ndb.Key(urlsafe=sessionKey).get()
             if not session:
                 raise endpoints.NotFoundException(
                     'No session found.')
-            if sessionKey in prof.sessionWishlist:
+            if not self._setMember(entryKey, True, session=session.key):
                 raise ConflictException("Session already in wishlist.")
-            prof.sessionWishlist.append(sessionKey)
             boolvar = True
 
         else:
             #if deleting and in profile, remove session key for session, return true.
-            if sessionKey in prof.sessionWishlist:
-                prof.sessionWishlist.remove(sessionKey)
+            if self._setMember(entryKey, False):
                 boolvar = True
             else:
                 #if session does not exist, say session cannot be deleted as it is not in wishlist.
                 raise ConflictException(
                     "Session not in wishlist.")
-        prof.put()
         return BooleanMessage(data=boolvar)
 
     @endpoints.method(SESSION_GET_REQUEST, 
@@ -794,61 +1710,280 @@ class ConferenceApi(remote.Service):
     def getSessionsInWishlist(self, request):
         """List all sessions for user profile."""
         prof = self._getProfileFromUser()
-        session_keys = [ndb.Key(urlsafe=sessionKey) for sessionKey in prof.sessionWishlist]
-        sessions = ndb.get_multi(session_keys)
-        return SessionForms(
-            items = [self._copySessionToForm(sess, sess.key.parent().get().name, 
-                ndb.Key(urlsafe=sess.speakerKey).get().speakerName) for sess in sessions]
-            )
+
+        @ndb.tasklet
+        def fetch(entryKey):
+            session = yield ndb.Key(urlsafe=entryKey.id()).get_async()
+            if session:
+                session = yield self._hydrateSessionAsync(session)
+            raise ndb.Return(session)
+
+        # each entry's session is fetched and hydrated as its batch arrives
+        forms = WishlistEntry.query(ancestor=prof.key).map(fetch, keys_only=True)
+        return SessionForms(items=[form for form in forms if form])
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
 # static methods for cache
 
+    @staticmethod
+    def _announcementKey():
+        """Return the key of the single Announcement entity."""
+        return ndb.Key(Announcement, 'nearlySoldOut')
+
+
+    @staticmethod
+    def _formatAnnouncement(announced):
+        """Return announcement text for an Announcement entity (or None)."""
+        names = sorted(announced.conferences.values()) if announced else []
+        if not names:
+            return ""
+        return '%s %s' % (
+            'Last chance to attend! The following conferences '
+            'are nearly sold out:',
+            ', '.join(names))
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _setAnnounced(wsck, name):
+        """Add (name) or remove (None) a conference; return entity if changed."""
+        announced = ConferenceApi._announcementKey().get() or \
+            Announcement(key=ConferenceApi._announcementKey(), conferences={})
+        if announced.conferences.get(wsck) == name:
+            return None
+        if name:
+            announced.conferences[wsck] = name
+        else:
+            del announced.conferences[wsck]
+        announced.put()
+        return announced
+
+
+    @staticmethod
+    def _updateAnnouncement(confKey, name, seatsAvailable):
+        """Add/remove a conference as its seat count enters/leaves the window."""
+        wsck = confKey.urlsafe()
+        if not 0 < seatsAvailable <= ANNOUNCEMENT_MAX_SEATS:
+            name = None
+        # cheap non-transactional check first; most calls change nothing
+        announced = ConferenceApi._announcementKey().get()
+        if (announced.conferences if announced else {}).get(wsck) == name:
+            return
+        if ConferenceApi._setAnnounced(wsck, name):
+            ConferenceApi._storeAnnouncement()
+
+
+    @staticmethod
+    def _storeAnnouncement():
+        """Copy the Announcement entity's text to memcache; return the text.
+
+        The entity is read after gets() on every attempt and written with
+        cas(), so when updates race, a writer that read an older entity
+        loses to one that read a newer one and retries; the older text
+        can't end up cached.
+        """
+        client = memcache.Client()
+        for _ in range(ANNOUNCEMENT_CAS_RETRIES):
+            cached = client.gets(MEMCACHE_ANNOUNCEMENTS_KEY)
+            announcement = ConferenceApi._formatAnnouncement(
+                ConferenceApi._announcementKey().get(use_cache=False))
+            if cached is None:
+                stored = client.add(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+            else:
+                stored = client.cas(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+            if stored:
+                _lastAnnouncement[0] = announcement
+                return announcement
+        # still racing; the next reader rebuilds it from the entity
+        memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        return announcement
+
+
+    @staticmethod
+    def _rebuildAnnouncement():
+        """Rebuild the memcache announcement from the Announcement entity.
+
+        Single-flight: only the caller that wins the lock reads datastore
+        and fills memcache, so a burst of misses on a cold cache costs one
+        datastore read. The others serve the last announcement this
+        instance saw; an instance that has seen none polls memcache
+        briefly for the winner's result, then reads the entity itself.
+        """
+        if memcache.add(MEMCACHE_ANNOUNCEMENTS_LOCK, 1,
+                        time=ANNOUNCEMENT_LOCK_TTL):
+            try:
+                announcement = ConferenceApi._formatAnnouncement(
+                    ConferenceApi._announcementKey().get())
+                memcache.add(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+            finally:
+                memcache.delete(MEMCACHE_ANNOUNCEMENTS_LOCK)
+            _lastAnnouncement[0] = announcement
+            return announcement
+
+        if _lastAnnouncement[0] is not None:
+            return _lastAnnouncement[0]
+        for _ in range(ANNOUNCEMENT_WAIT_POLLS):
+            sleep(ANNOUNCEMENT_WAIT_INTERVAL)
+            announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+            if announcement is not None:
+                break
+        else:
+            announcement = ConferenceApi._formatAnnouncement(
+                ConferenceApi._announcementKey().get())
+        _lastAnnouncement[0] = announcement
+        return announcement
+
+
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Check the Announcement entity against the seat shards, repair it
+        if they disagree & assign to memcache; used by memcache cron jobs.
+
+        The seatsAvailable range query only nominates candidates: it is
+        eventually consistent and runs right after reconcileSeats writes.
+        Candidates and announced conferences are then read by key and
+        judged by their shard sums, and each difference is applied with
+        _setAnnounced, like a registration would.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
+        candidates = Conference.query(ndb.AND(
+            Conference.seatsAvailable <= ANNOUNCEMENT_MAX_SEATS,
             Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+        ).fetch(keys_only=True)
+        announced = ConferenceApi._announcementKey().get()
+        current = announced.conferences if announced else {}
+        keys = list(set(candidates).union(
+            ndb.Key(urlsafe=wsck) for wsck in current))
+
+        confs = [conf for conf in ndb.get_multi(keys) if conf]
+        seatCounts = seats.getSeatsAvailable(confs)
+        expected = dict((conf.key.urlsafe(), conf.name) for conf in confs
+                        if 0 < seatCounts[conf.key] <= ANNOUNCEMENT_MAX_SEATS)
+        if current != expected:
+            logging.warning('Announcement out of sync: have %r, expected %r',
+                current, expected)
+            for wsck in set(current).union(expected):
+                if current.get(wsck) != expected.get(wsck):
+                    ConferenceApi._setAnnounced(wsck, expected.get(wsck))
+        return ConferenceApi._storeAnnouncement()
+
+
+    @staticmethod
+    def _syncSessionNames(conferenceKey=None, speakerKey=None, cursor=None):
+        """Copy current conference/speaker names onto one batch of sessions.
+
+        Sessions are limited to one conference or one speaker when given,
+        otherwise all sessions are visited (backfill). Returns the cursor
+        for the next batch, or None when done.
+        """
+        if conferenceKey:
+            query = Session.query(ancestor=ndb.Key(urlsafe=conferenceKey))
+        elif speakerKey:
+            query = ConferenceApi._speakerSessionsQuery(ndb.Key(urlsafe=speakerKey))
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            query = Session.query()
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        sessions, nextCursor, more = query.fetch_page(
+            SESSION_BATCH_SIZE, start_cursor=cursor)
 
-        return announcement
+        keys = set()
+        for sess in sessions:
+            keys.add(sess.key.parent())
+            if ConferenceApi._getSpeakerKey(sess):
+                keys.add(ConferenceApi._getSpeakerKey(sess))
+        keys = list(keys)
+        entities = dict(zip(keys, ndb.get_multi(keys)))
+
+        changed = []
+        for sess in sessions:
+            conf = entities.get(sess.key.parent())
+            speaker = entities.get(ConferenceApi._getSpeakerKey(sess))
+            conferenceName = getattr(conf, 'name', None)
+            speakerName = getattr(speaker, 'speakerName', None)
+            if (sess.conferenceName, sess.speakerName) != (conferenceName, speakerName):
+                sess.conferenceName = conferenceName
+                sess.speakerName = speakerName
+                changed.append(sess)
+        ndb.put_multi(changed)
+        ConferenceApi._bumpSchedule(*[sess.key.parent() for sess in changed])
+
+        if more and nextCursor:
+            return nextCursor.urlsafe()
+        return None
+
+
+    @staticmethod
+    def _migrateSessionSpeakers(cursor=None):
+        """Move one batch of sessions from legacySpeakerKey to speakerKey.
+
+        Rosters already count legacy sessions (see _getSpeakerKey), so only
+        the sessions change. Returns the cursor for the next batch, or None
+        when done.
+        """
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        sessions, nextCursor, more = Session.query().fetch_page(
+            SESSION_BATCH_SIZE, start_cursor=cursor)
+
+        changed = []
+        for sess in sessions:
+            if not sess.legacySpeakerKey:
+                continue
+            if not sess.speakerKey:
+                sess.speakerKey = ndb.Key(urlsafe=sess.legacySpeakerKey)
+            sess.legacySpeakerKey = None
+            changed.append(sess)
+        ndb.put_multi(changed)
+
+        if more and nextCursor:
+            return nextCursor.urlsafe()
+        return None
 
 
     @staticmethod
-    def _cacheSpeaker(speakerKey, conferenceKey):
-        """Store main speaker in memcache."""
-        #set speaker key and conference key. Query sessions with conference key. If sessions > 1, get speaker key that fits that criteria and set as speaker. 
-        speakerKey = ndb.Key(urlsafe=speakerKey)
+    def _migrateProfiles(cursor=None):
+        """Move one batch of profiles' legacy lists into child entities.
+
+        Returns the cursor for the next batch, or None when done.
+        """
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        profiles, nextCursor, more = Profile.query().fetch_page(
+            PROFILE_BATCH_SIZE, start_cursor=cursor)
+
+        migrated = [prof.key for prof in profiles
+                    if prof.sessionWishlist or prof.conferenceKeysToAttend]
+        for profKey in migrated:
+            ConferenceApi._migrateProfileLists(profKey)
+        cache.invalidate(*migrated)
+
+        if more and nextCursor:
+            return nextCursor.urlsafe()
+        return None
+
+
+    @staticmethod
+    def _cacheSpeaker(conferenceKey, setLatest=False):
+        """Store a conference's featured speaker in memcache.
+
+        setLatest also makes it what getFeaturedSpeaker returns; only the
+        /tasks/set_speaker path passes it, so cache refills on reads and
+        warmup don't change the latest featured speaker.
+        """
+        #the roster keeps per-speaker session counts and the featured speaker up to date as sessions are created, so this only renders the message.
         confKey = ndb.Key(urlsafe=conferenceKey)
-        query = Session.query(ancestor=confKey)
-        sessions = query.filter(Session.speakerKey == speakerKey)
-        session_names=','.join([x.session_name for x in sessions])
-        sessions.count()
+        roster = ConferenceApi._getRoster(confKey)
         cacheSpeaker = ""
-        if sessions > 1:
-            sKey = ndb.Key(urlsafe=speakerKey)
-            speaker = sKey.get()
-            speakerMsg = '%s %s' % (
-                'The featured speaker for this conference is: ', speaker.speakerName, 'He is speaking in sessions:', session_names)
-            memcache.set(MEMCACHE_SPEAKER_KEY, speakerMsg)
+        if roster.featuredSpeakerKey:
+            speakerKey = roster.featuredSpeakerKey
+            speaker = cache.get(speakerKey)
+            sessions = ConferenceApi._speakerSessionsQuery(speakerKey, confKey)
+            session_names = ','.join([x.session_name for x in sessions])
+            cacheSpeaker = '%s %s %s %s' % (
+                'The featured speaker for this conference is:',
+                getattr(speaker, 'speakerName', ''),
+                'He is speaking in sessions:', session_names)
+            if setLatest:
+                memcache.set(MEMCACHE_SPEAKER_KEY, cacheSpeaker)
+        memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY % conferenceKey, cacheSpeaker)
         return cacheSpeaker
 
 
@@ -863,6 +1998,20 @@ class ConferenceApi(remote.Service):
             cacheSpeaker = ""
         return StringMessage(data=memcache.get(MEMCACHE_SPEAKER_KEY) or "")
 
+
+    @endpoints.method(CONF_GET_REQUEST,
+        StringMessage,
+        path='conference/{websafeConferenceKey}/speaker/featured', http_method='GET',
+        name='getConferenceFeaturedSpeaker')
+    def getConferenceFeaturedSpeaker(self, request):
+        """Get a conference's featured speaker message from memcache."""
+        cacheSpeaker = memcache.get(
+            MEMCACHE_FEATURED_SPEAKER_KEY % request.websafeConferenceKey)
+        if cacheSpeaker is None:
+            # evicted or never set; the roster makes rebuilding cheap
+            cacheSpeaker = self._cacheSpeaker(request.websafeConferenceKey)
+        return StringMessage(data=cacheSpeaker)
+
 # TODO 1
 
-api = endpoints.api_server([ConferenceApi]) # register API
+api = rpcstats.middleware(endpoints.api_server([ConferenceApi])) # register API
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""confstats.py
+
+Value histograms for the Conference fields queryConferences can filter
+on, and the cost-based planner that uses them. Conference writes queue
+their histogram changes on the 'histograms' pull queue in the same
+transaction; a worker leases them in batches and applies each batch in
+one transaction, so writers never contend on the histograms. Cron
+rebuilds them in full daily.
+
+"""
+
+import json
+import logging
+import operator
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import cache
+import dispatch
+from models import Conference
+from models import FieldHistogram
+
+STATS_FIELDS = ['city', 'topics', 'month', 'maxAttendees']
+INT_FIELDS = ['month', 'maxAttendees']
+
+QUEUE_NAME = 'histograms'
+WORKER_URL = '/tasks/apply_histograms'
+LEASE_SECONDS = 60
+BATCH_SIZE = 500
+TIME_BUDGET = 50        # seconds of leasing per worker run
+
+# relative cost of reading one index entry (keys-only), one entity from
+# datastore and one entity from memcache
+KEY_READ_COST = 1.0
+ENTITY_READ_COST = 10.0
+CACHE_READ_COST = 1.0
+
+# conference.OPERATORS values -> comparison; works on plain values and on
+# ndb properties (where it builds a filter)
+COMPARISONS = {
+    '=':  operator.eq,
+    '!=': operator.ne,
+    '<':  operator.lt,
+    '<=': operator.le,
+    '>':  operator.gt,
+    '>=': operator.ge,
+}
+
+
+def _histogramKey(field):
+    return ndb.Key(FieldHistogram, field)
+
+
+def loadHistograms():
+    """Return {field: FieldHistogram or None}, read through the entity cache."""
+    return dict(zip(STATS_FIELDS,
+        cache.getMulti([_histogramKey(field) for field in STATS_FIELDS])))
+
+
+def fieldValues(conf, field):
+    """Return the indexed values of field on conf (a list, for topics)."""
+    value = getattr(conf, field, None)
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def matches(conf, filtr):
+    """Datastore semantics: true if any indexed value satisfies the filter."""
+    compare = COMPARISONS[filtr["operator"]]
+    return any(compare(value, filtr["value"])
+               for value in fieldValues(conf, filtr["field"]))
+
+
+@ndb.transactional(xg=True)
+def _applyDeltas(deltas):
+    """Apply {field: {value: delta}} and total change to the histograms."""
+    keys = [_histogramKey(field) for field in STATS_FIELDS]
+    histograms = ndb.get_multi(keys)
+    for i, field in enumerate(STATS_FIELDS):
+        hist = histograms[i] or FieldHistogram(key=keys[i], counts={}, total=0)
+        hist.total += deltas['total']
+        for value, delta in deltas[field].items():
+            count = hist.counts.get(value, 0) + delta
+            if count > 0:
+                hist.counts[value] = count
+            else:
+                hist.counts.pop(value, None)
+        histograms[i] = hist
+    ndb.put_multi(histograms)
+
+
+def snapshot(conf):
+    """Return a copy of conf's stats fields that later edits won't change."""
+    values = {}
+    for field in STATS_FIELDS:
+        value = getattr(conf, field, None)
+        values[field] = list(value) if isinstance(value, list) else value
+    return Conference(**values)
+
+
+def _changeDeltas(old, new):
+    """Return histogram deltas for a conference going from old to new.
+
+    Either may be None (create/delete); both just need Conference's
+    stats field attributes, so a ConferenceForm works as well. Returns
+    None if no histogram changes.
+    """
+    deltas = {'total': (1 if new else 0) - (1 if old else 0)}
+    for field in STATS_FIELDS:
+        delta = {}
+        for value in fieldValues(old, field):
+            delta[unicode(value)] = delta.get(unicode(value), 0) - 1
+        for value in fieldValues(new, field):
+            delta[unicode(value)] = delta.get(unicode(value), 0) + 1
+        deltas[field] = dict((v, d) for v, d in delta.items() if d)
+    if deltas['total'] or any(deltas[field] for field in STATS_FIELDS):
+        return deltas
+    return None
+
+
+def recordChangeAsync(old, new):
+    """Start queueing the histogram change from old to new; return the RPC.
+
+    Must be called in the transaction that writes the conference, so the
+    change is queued if and only if the write commits. Returns None when
+    there's nothing to record. Call wakeWorker() after the commit.
+    """
+    deltas = _changeDeltas(old, new)
+    if deltas is None:
+        return None
+    return taskqueue.Queue(QUEUE_NAME).add_async(
+        taskqueue.Task(payload=json.dumps(deltas), method='PULL'),
+        transactional=True)
+
+
+def wakeWorker():
+    """Make sure a worker applies queued changes soon; never raises."""
+    try:
+        dispatch.enqueueCoalesced(WORKER_URL, QUEUE_NAME)
+    except taskqueue.Error:
+        # the conference write already committed; cron picks the change up
+        logging.warning('Could not wake histogram worker', exc_info=True)
+
+
+def _sumDeltas(deltasList):
+    summed = dict((field, {}) for field in STATS_FIELDS)
+    summed['total'] = 0
+    for deltas in deltasList:
+        summed['total'] += deltas['total']
+        for field in STATS_FIELDS:
+            for value, delta in deltas.get(field, {}).items():
+                summed[field][value] = summed[field].get(value, 0) + delta
+    return summed
+
+
+def applyQueued():
+    """Apply queued histogram changes for up to TIME_BUDGET seconds.
+
+    Each leased batch is summed and applied in one transaction, then
+    deleted. A batch whose transaction fails keeps its lease until it
+    expires and is applied by a later run; one applied but not deleted
+    would be counted twice until the next full rebuild. Returns the
+    number of changes applied.
+    """
+    queue = taskqueue.Queue(QUEUE_NAME)
+    start = time.time()
+    applied = 0
+    while time.time() - start < TIME_BUDGET:
+        tasks = queue.lease_tasks(LEASE_SECONDS, BATCH_SIZE)
+        if not tasks:
+            break
+        deltasList = []
+        for task in tasks:
+            try:
+                deltasList.append(json.loads(task.payload))
+            except ValueError:
+                logging.error('Dropping malformed histogram change %s', task.name)
+        _applyDeltas(_sumDeltas(deltasList))
+        queue.delete_tasks(tasks)
+        applied += len(tasks)
+        if len(tasks) < BATCH_SIZE:
+            break
+    if applied:
+        cache.invalidate(*[_histogramKey(field) for field in STATS_FIELDS])
+    return applied
+
+
+def rebuildHistograms(batchSize=200):
+    """Recount every histogram from scratch over all conferences."""
+    counts = dict((field, {}) for field in STATS_FIELDS)
+    total = 0
+    cursor = None
+    more = True
+    while more:
+        confs, cursor, more = Conference.query().fetch_page(
+            batchSize, start_cursor=cursor)
+        total += len(confs)
+        for conf in confs:
+            for field in STATS_FIELDS:
+                for value in fieldValues(conf, field):
+                    counts[field][unicode(value)] = \
+                        counts[field].get(unicode(value), 0) + 1
+    ndb.put_multi([FieldHistogram(key=_histogramKey(field),
+                                  counts=counts[field], total=total)
+                   for field in STATS_FIELDS])
+    cache.invalidate(*[_histogramKey(field) for field in STATS_FIELDS])
+    return total
+
+
+def _estimateRows(hist, filters):
+    """Estimate conferences matching all filters on one field."""
+    matching = 0
+    for value, count in hist.counts.items():
+        if hist.key.id() in INT_FIELDS:
+            value = int(value)
+        if all(COMPARISONS[f["operator"]](value, f["value"]) for f in filters):
+            matching += count
+    return min(matching, hist.total)
+
+
+def _describe(filters):
+    return ['%s %s %s' % (f["field"], f["operator"], f["value"]) for f in filters]
+
+
+def plan(filters):
+    """Choose how to run filters; return a plan dict.
+
+    Strategies:
+      scan             no filters; walk all conferences in name order
+      intersect        keys-only scan per field, intersect, hydrate matches
+      residual         query the most selective field, check the rest in memory
+      keysOnlyHydrate  keys-only query on the most selective field, hydrate
+                       through the entity cache, check the rest in memory
+    """
+    groups = {}
+    for filtr in filters:
+        groups.setdefault(filtr["field"], []).append(filtr)
+    result = {'strategy': 'scan', 'datastoreFilters': [], 'residualFilters': [],
+              'drivingField': None, 'estimatedRows': None, 'estimatedCost': None}
+    if not groups:
+        return result
+
+    hists = loadHistograms()
+    if not all(hists.get(field) for field in groups):
+        # no statistics yet; intersecting needs no guesses about selectivity
+        result.update(strategy='intersect', datastoreFilters=_describe(filters))
+        return result
+
+    total = max(hists[field].total for field in groups) or 1
+    rows = dict((field, _estimateRows(hists[field], group))
+                for field, group in groups.items())
+    selectivity = 1.0
+    for field in groups:
+        selectivity *= float(rows[field]) / total
+    resultRows = total * selectivity
+
+    stats = cache.getStats()
+    hydrateCost = (stats['hitRatio'] * CACHE_READ_COST +
+                   (1 - stats['hitRatio']) * ENTITY_READ_COST)
+    driving = min(groups, key=lambda field: rows[field])
+    costs = {
+        'intersect': sum(rows.values()) * KEY_READ_COST + resultRows * hydrateCost,
+        'residual': rows[driving] * ENTITY_READ_COST,
+        'keysOnlyHydrate': rows[driving] * (KEY_READ_COST + hydrateCost),
+    }
+    strategy = min(costs, key=lambda name: costs[name])
+
+    if strategy == 'intersect':
+        pushed, residual = filters, []
+    else:
+        pushed = groups[driving]
+        residual = [f for f in filters if f["field"] != driving]
+        result['drivingField'] = driving
+    result.update(strategy=strategy,
+                  datastoreFilters=_describe(pushed),
+                  residualFilters=_describe(residual),
+                  estimatedRows=int(round(resultRows)),
+                  estimatedCost=costs[strategy])
+    return result
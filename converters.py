@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Precompiled ndb entity -> ProtoRPC message converters. The copy plan for
+each (model, message) pair is worked out once when the module loads, so
+converting an entity is a straight loop over (field, getter) pairs with
+no per-call reflection or field-name checks.
+
+"""
+
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+from models import Speaker
+from models import SpeakerForm
+from models import TeeShirtSize
+
+# (model, message) -> Converter
+_registry = {}
+
+
+def _attrGetter(name, transform=None):
+    """Return a function reading attribute name, optionally transformed."""
+    if transform is None:
+        return lambda entity: getattr(entity, name)
+    return lambda entity: transform(getattr(entity, name))
+
+
+def _urlsafeKey(entity):
+    return entity.key.urlsafe()
+
+
+def _urlsafe(key):
+    return key.urlsafe() if key else None
+
+
+class Converter(object):
+    """Copy plan from one ndb model to one ProtoRPC message class."""
+
+    def __init__(self, model, message, transforms=None, keyField=None):
+        transforms = transforms or {}
+        self.message = message
+        self.plan = []
+        for field in message.all_fields():
+            if hasattr(model, field.name):
+                self.plan.append((field.name,
+                    _attrGetter(field.name, transforms.get(field.name))))
+            elif field.name == keyField:
+                self.plan.append((field.name, _urlsafeKey))
+        # none of the outbound forms have required fields today; only pay
+        # for check_initialized() if one ever does
+        self.checkRequired = any(field.required for field in message.all_fields())
+
+    def convert(self, entity, **extra):
+        """Return a message for entity; extra sets additional fields."""
+        msg = self.message()
+        for name, getter in self.plan:
+            setattr(msg, name, getter(entity))
+        for name, value in extra.iteritems():
+            setattr(msg, name, value)
+        if self.checkRequired:
+            msg.check_initialized()
+        return msg
+
+    def convertAll(self, entities):
+        """Return a list of messages, one per (non-None) entity."""
+        convert = self.convert
+        return [convert(entity) for entity in entities if entity]
+
+
+def register(model, message, transforms=None, keyField=None):
+    """Build and register the converter for (model, message)."""
+    converter = Converter(model, message, transforms, keyField)
+    _registry[(model, message)] = converter
+    return converter
+
+
+def converterFor(model, message):
+    """Return the registered converter for (model, message)."""
+    return _registry[(model, message)]
+
+
+CONFERENCE_CONVERTER = register(Conference, ConferenceForm,
+    transforms={'startDate': str, 'endDate': str},
+    keyField='websafeKey')
+
+SESSION_CONVERTER = register(Session, SessionForm,
+    transforms={'session_name': str, 'highlights': str, 'speakerKey': _urlsafe,
+                'typeOfSession': str, 'startDate': str, 'startTime': str},
+    keyField='websafeSessionKey')
+
+SPEAKER_CONVERTER = register(Speaker, SpeakerForm, keyField='websafeKey')
+
+PROFILE_CONVERTER = register(Profile, ProfileForm,
+    transforms={'teeShirtSize': lambda size: getattr(TeeShirtSize, size)})
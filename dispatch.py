@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""dispatch.py
+
+Background task dispatch. Everything conference.py queues goes through
+here so enqueues and executions are counted; work that only needs to run
+once per burst (e.g. recomputing a conference's featured speaker) is
+coalesced into one named task per key and time window.
+
+"""
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+COALESCE_WINDOW = 10    # seconds
+MEMCACHE_TASK_STATS_KEY = "TASK_STATS:%s:%s"
+STAT_NAMES = ('enqueued', 'coalesced', 'executed')
+
+
+def _count(stat, url, delta=1):
+    memcache.offset_multi({MEMCACHE_TASK_STATS_KEY % (stat, url): delta},
+                          initial_value=0)
+
+
+def enqueue(url, params=None, transactional=False):
+    """Add one task to the default push queue."""
+    taskqueue.add(url=url, params=params, transactional=transactional)
+    _count('enqueued', url)
+
+
+def enqueueAsync(url, params=None, transactional=False):
+    """Start adding one task to the default push queue; return the RPC."""
+    _count('enqueued', url)
+    return taskqueue.Queue().add_async(
+        taskqueue.Task(url=url, params=params), transactional=transactional)
+
+
+def enqueueBatch(url, paramsList):
+    """Add a task per params dict, in as few Queue.add calls as allowed."""
+    tasks = [taskqueue.Task(url=url, params=params) for params in paramsList]
+    queue = taskqueue.Queue()
+    for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+    _count('enqueued', url, len(tasks))
+
+
+def enqueueCoalesced(url, coalesceKey, params=None, window=COALESCE_WINDOW):
+    """Add at most one task per (url, coalesceKey) per time window.
+
+    The task is named after the key and window and runs when the window
+    closes, so every call made during the window is covered by it; calls
+    after the first just hit the existing name. Coalesced tasks can't be
+    transactional, as named tasks aren't allowed in transactions.
+    """
+    now = time.time()
+    bucket = int(now // window)
+    name = '%s-%s-%d' % (url.strip('/').replace('/', '-'),
+                         hashlib.md5(coalesceKey).hexdigest(), bucket)
+    try:
+        taskqueue.add(name=name, url=url, params=params,
+                      countdown=(bucket + 1) * window - now)
+        _count('enqueued', url)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        _count('coalesced', url)
+
+
+def recordExecution(url):
+    """Count one run of the task handler at url."""
+    _count('executed', url)
+
+
+def getStats(urls):
+    """Return {url: {stat: count}} for the given task urls."""
+    keys = dict(((stat, url), MEMCACHE_TASK_STATS_KEY % (stat, url))
+                for stat in STAT_NAMES for url in urls)
+    values = memcache.get_multi(keys.values())
+    return dict((url, dict((stat, int(values.get(keys[(stat, url)], 0)))
+                           for stat in STAT_NAMES))
+                for url in urls)
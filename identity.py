@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""identity.py
+
+Request-scoped identity. The signed-in user, their user ID and their
+Profile are each resolved at most once per request and kept on a
+thread-local tagged with the request's log ID, so API methods and their
+helpers can ask for them as often as they like. Callers that only need
+the user ID or profile key never load the Profile.
+
+"""
+
+import os
+import threading
+
+import endpoints
+from google.appengine.ext import ndb
+
+import cache
+from models import Profile
+from models import TeeShirtSize
+from utils import getUserId
+
+_local = threading.local()
+_UNSET = object()
+
+
+class Identity(object):
+    """The user behind one request, resolved lazily."""
+
+    def __init__(self, requestId):
+        self.requestId = requestId
+        self._user = _UNSET
+        self._userId = None
+        self._profile = None
+
+    @property
+    def user(self):
+        """The endpoints user, or None if the request isn't signed in."""
+        if self._user is _UNSET:
+            self._user = endpoints.get_current_user()
+        return self._user
+
+    def requireUser(self):
+        """Return the user, raising UnauthorizedException if there is none."""
+        if not self.user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return self.user
+
+    @property
+    def userId(self):
+        if self._userId is None:
+            self._userId = getUserId(self.requireUser())
+        return self._userId
+
+    @property
+    def profileKey(self):
+        return ndb.Key(Profile, self.userId)
+
+    def getProfile(self):
+        """Return the user's Profile, creating it if non-existent."""
+        if self._profile is None:
+            profile = cache.get(self.profileKey)
+            if not profile:
+                user = self.requireUser()
+                profile = Profile(
+                    key = self.profileKey,
+                    displayName = user.nickname(),
+                    mainEmail= user.email(),
+                    teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
+                )
+                profile.put()
+            self._profile = profile
+        return self._profile
+
+
+def current():
+    """Return the Identity for the request being served."""
+    requestId = os.environ.get('REQUEST_LOG_ID')
+    identity = getattr(_local, 'identity', None)
+    if requestId is None:
+        # no way to tell requests apart, so don't share anything
+        return Identity(None)
+    if identity is None or identity.requestId != requestId:
+        identity = _local.identity = Identity(requestId)
+    return identity
+
+
+def profileWritten(profKey):
+    """Drop cached copies of a Profile; call after every Profile put."""
+    cache.invalidate(profKey)
+    identity = getattr(_local, 'identity', None)
+    if identity is not None and identity._profile is not None \
+            and identity._profile.key == profKey:
+        identity._profile = None
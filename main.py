@@ -12,42 +12,205 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import time
+_loadStart = time.time()
+
+import json
+import logging
+
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+import cache
+import confstats
+import dispatch
+import notify
+import rpcstats
+import seats
+import textsearch
+import warmup
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
         # TODO 1
-        # use _cacheAnnouncement() to set announcement in Memcache
+        # announcements are maintained as registrations happen; this only
+        # reconciles seat counts and checks the stored set is consistent
+        seats.reconcileSeats()
         ConferenceApi._cacheAnnouncement()
 
 
+class RefreshConferenceStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the conference field histograms used for query planning."""
+        confstats.rebuildHistograms()
+        self.response.set_status(204)
+
+
+class ApplyHistogramsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Apply histogram changes a missed worker run left queued (cron)."""
+        self._apply()
+
+    def post(self):
+        """Apply histogram changes queued in the last window."""
+        dispatch.recordExecution(self.request.path)
+        self._apply()
+
+    def _apply(self):
+        logging.info('Histograms: applied %d changes', confstats.applyQueued())
+        self.response.set_status(204)
+
+
+class SendNotificationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Drain notifications left over from earlier runs (cron)."""
+        self._process()
+
+    def post(self):
+        """Drain notifications queued in the last window."""
+        dispatch.recordExecution(self.request.path)
+        self._process()
+
+    def _process(self):
+        stats = notify.processQueue()
+        logging.info('Notifications: %(sent)d sent, %(failed)d failed of '
+                     '%(leased)d leased in %(seconds).1fs (%(perSecond).1f/s)',
+                     stats)
+        self.response.set_status(204)
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
-            self.request.get('email'),                  # to
-            'You created a new Conference!',            # subj
-            'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
+        """Forward a confirmation task queued by the previous release."""
+        # deprecated 2026-10-17: only tasks queued before notifications
+        # moved to the pull queue arrive here; delete with its route
+        dispatch.recordExecution(self.request.path)
+        notify.queueNotification('conferenceCreatedLegacy',
+            self.request.get('email'),
+            conferenceInfo=self.request.get('conferenceInfo'))
+        self.response.set_status(204)
 
 class SetSpeaker(webapp2.RequestHandler):
     def post(self):
-        ConferenceApi._cacheSpeaker(
-            self.request.get('speakerKey'),
-            self.request.get('conferenceKey'))
+        dispatch.recordExecution(self.request.path)
+        ConferenceApi._cacheSpeaker(self.request.get('conferenceKey'),
+                                    setLatest=True)
+        self.response.set_status(204)
+
+class SyncSessionNamesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start a backfill of denormalized names over all sessions."""
+        dispatch.enqueue('/tasks/sync_session_names')
+        self.response.set_status(202)
+
+    def post(self):
+        """Sync one batch of session names and chain the next batch."""
+        dispatch.recordExecution(self.request.path)
+        params = {
+            'conferenceKey': self.request.get('conferenceKey'),
+            'speakerKey': self.request.get('speakerKey'),
+        }
+        cursor = ConferenceApi._syncSessionNames(
+            cursor=self.request.get('cursor'), **params)
+        if cursor:
+            params['cursor'] = cursor
+            dispatch.enqueue('/tasks/sync_session_names', params=params)
+        self.response.set_status(204)
+
+class MigrateSessionSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving sessions off the string speakerKey."""
+        dispatch.enqueue('/tasks/migrate_session_speakers')
+        self.response.set_status(202)
+
+    def post(self):
+        """Migrate one batch of sessions and chain the next batch."""
+        dispatch.recordExecution(self.request.path)
+        cursor = ConferenceApi._migrateSessionSpeakers(self.request.get('cursor'))
+        if cursor:
+            dispatch.enqueue('/tasks/migrate_session_speakers',
+                params={'cursor': cursor})
+        self.response.set_status(204)
+
+class MigrateProfileListsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving profile wishlists/registrations into child entities."""
+        dispatch.enqueue('/tasks/migrate_profile_lists')
+        self.response.set_status(202)
+
+    def post(self):
+        """Migrate one batch of profiles and chain the next batch."""
+        dispatch.recordExecution(self.request.path)
+        cursor = ConferenceApi._migrateProfiles(self.request.get('cursor'))
+        if cursor:
+            dispatch.enqueue('/tasks/migrate_profile_lists',
+                params={'cursor': cursor})
+        self.response.set_status(204)
+
+class IndexSearchHandler(webapp2.RequestHandler):
+    def post(self):
+        """Index the entities a create committed (see _indexLater)."""
+        dispatch.recordExecution(self.request.path)
+        keys = [ndb.Key(urlsafe=key) for key in self.request.get_all('key')]
+        textsearch.indexEntities(ndb.get_multi(keys))
+        self.response.set_status(204)
+
+class ReindexSearchHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start rebuilding the keyword search index for every kind."""
+        dispatch.enqueueBatch('/tasks/reindex_search',
+            [{'kind': kind} for kind in textsearch.INDEXED_FIELDS])
+        self.response.set_status(202)
+
+    def post(self):
+        """Index one batch of one kind and chain the next batch."""
+        dispatch.recordExecution(self.request.path)
+        kind = self.request.get('kind')
+        cursor = ConferenceApi._reindexSearch(kind, self.request.get('cursor'))
+        if cursor:
+            dispatch.enqueue('/tasks/reindex_search',
+                params={'kind': kind, 'cursor': cursor})
         self.response.set_status(204)
 
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Prime caches before this instance serves user traffic."""
+        report = warmup.run(importMs=_loadMs)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(report))
+
+class AdminStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report per-endpoint RPC stats, entity cache hits and task counts."""
+        taskUrls = [route.template for route in self.app.router.match_routes
+                    if route.template.startswith('/tasks/')]
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'endpoints': rpcstats.getStats(),
+            'entityCache': cache.getStats(),
+            'tasks': dispatch.getStats(taskUrls),
+            'warmup': warmup.getReport(),
+        }, indent=2, sort_keys=True))
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/refresh_conference_stats', RefreshConferenceStatsHandler),
+    ('/crons/apply_histograms', ApplyHistogramsHandler),
+    ('/tasks/apply_histograms', ApplyHistogramsHandler),
+    ('/crons/send_notifications', SendNotificationsHandler),
+    ('/tasks/send_notifications', SendNotificationsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/set_speaker',
-        SetSpeaker)
+        SetSpeaker),
+    ('/tasks/sync_session_names', SyncSessionNamesHandler),
+    ('/tasks/migrate_session_speakers', MigrateSessionSpeakersHandler),
+    ('/tasks/migrate_profile_lists', MigrateProfileListsHandler),
+    ('/tasks/index_search', IndexSearchHandler),
+    ('/tasks/reindex_search', ReindexSearchHandler),
+    ('/admin/stats', AdminStatsHandler),
+    ('/_ah/warmup', WarmupHandler),
 ], debug=True)
+app = rpcstats.middleware(app)
+
+# module load covers endpoints, protorpc, models and the API service
+_loadMs = (time.time() - _loadStart) * 1000
@@ -23,10 +23,22 @@ class ConflictException(endpoints.ServiceException):
 
 class Profile(ndb.Model):
     """Profile -- User profile object"""
+    _use_memcache = False   # cached by cache.py instead
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy lists, moved to Registration/WishlistEntry children on first
+    # use or by /tasks/migrate_profile_lists
     sessionWishlist = ndb.StringProperty(repeated=True)
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+
+class Registration(ndb.Model):
+    """Registration -- Profile attending a Conference; child of the Profile, id is the websafe conference key"""
+    conference = ndb.KeyProperty(kind='Conference')
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- Session on a Profile's wishlist; child of the Profile, id is the websafe session key"""
+    session = ndb.KeyProperty(kind='Session')
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -40,12 +52,18 @@ class ProfileForm(messages.Message):
     teeShirtSize = messages.EnumField('TeeShirtSize', 3)
     sessionWishlist = messages.StringField(4, repeated = True)
 
+class ProfileForms(messages.Message):
+    """ProfileForms -- multiple Profile outbound form message"""
+    items = messages.MessageField(ProfileForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
 
 class Conference(ndb.Model):
     """Conference -- Conference object"""
+    _use_memcache = False   # cached by cache.py instead
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
@@ -57,6 +75,24 @@ class Conference(ndb.Model):
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
 
+class Announcement(ndb.Model):
+    """Announcement -- conferences that are nearly sold out"""
+    conferences = ndb.JsonProperty()  # websafe key -> name
+
+class FieldHistogram(ndb.Model):
+    """FieldHistogram -- value counts of one Conference field, for query planning"""
+    counts = ndb.JsonProperty()  # value (as string) -> number of conferences
+    total = ndb.IntegerProperty(default=0, indexed=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a conference's remaining seat count"""
+    seats = ndb.IntegerProperty(default=0, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class SeatReconcile(ndb.Model):
+    """SeatReconcile -- when shard sums were last written back to conferences"""
+    lastRun = ndb.DateTimeProperty(indexed=False)
+
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
     name            = messages.StringField(1)
@@ -75,6 +111,7 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -104,6 +141,14 @@ class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
 
+class QueryPlanForm(messages.Message):
+    """QueryPlanForm -- outbound conference query plan & cost estimate message"""
+    strategy = messages.StringField(1)
+    datastoreFilters = messages.StringField(2, repeated=True)
+    residualFilters = messages.StringField(3, repeated=True)
+    estimatedRows = messages.IntegerField(4)
+    estimatedCost = messages.FloatField(5)
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
@@ -112,11 +157,24 @@ class Session(ndb.Model):
     """Session object."""
     session_name = ndb.StringProperty(required=True)
     highlights = ndb.StringProperty()
-    speakerKey = ndb.StringProperty()
+    speakerKey = ndb.KeyProperty('speaker', kind='Speaker')
+    # urlsafe speaker key written before speakerKey became a KeyProperty;
+    # cleared by /tasks/migrate_session_speakers
+    legacySpeakerKey = ndb.StringProperty('speakerKey')
     duration = ndb.IntegerProperty()
     typeOfSession = ndb.StringProperty()
     startDate = ndb.DateProperty(required = True)
     startTime = ndb.TimeProperty(required=True)
+    # denormalized display names, kept in sync by /tasks/sync_session_names
+    speakerName = ndb.StringProperty(indexed=False)
+    conferenceName = ndb.StringProperty(indexed=False)
+
+class ConferenceSpeakers(ndb.Model):
+    """ConferenceSpeakers -- roster of speakers with sessions in a conference"""
+    speakerKeys = ndb.KeyProperty(kind='Speaker', repeated=True, indexed=False)
+    # urlsafe speaker key -> number of sessions in this conference
+    sessionCounts = ndb.JsonProperty()
+    featuredSpeakerKey = ndb.KeyProperty(kind='Speaker', indexed=False)
 
 class SessionForm(messages.Message):
     """Session outbound form message."""
@@ -135,6 +193,39 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """Session multiple outbound form message."""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class ImportSessionsForm(messages.Message):
+    """ImportSessionsForm -- bulk session import inbound form message"""
+    websafeConferenceKey = messages.StringField(1, required=True)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    csv = messages.StringField(3)   # alternative to sessions, header row first
+
+class ImportRowResult(messages.Message):
+    """ImportRowResult -- outcome of importing one row"""
+    row = messages.IntegerField(1)
+    websafeKey = messages.StringField(2)
+    error = messages.StringField(3)
+
+class ImportResultForms(messages.Message):
+    """ImportResultForms -- bulk import outbound form message"""
+    items = messages.MessageField(ImportRowResult, 1, repeated=True)
+    imported = messages.IntegerField(2)
+
+class SessionQueryForm(messages.Message):
+    """SessionQueryForm -- Session query inbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    typeOfSession = messages.StringField(2)
+    excludeTypeOfSession = messages.StringField(3)
+    speakerKey = messages.StringField(4)
+    startTimeFrom = messages.StringField(5)     # HH:MM, inclusive
+    startTimeBefore = messages.StringField(6)   # HH:MM, exclusive
+    startDateFrom = messages.StringField(7)     # YYYY-MM-DD, inclusive
+    startDateTo = messages.StringField(8)       # YYYY-MM-DD, inclusive
+    minDuration = messages.IntegerField(9)
+    maxDuration = messages.IntegerField(10)
+    pageSize = messages.IntegerField(11)
+    pageToken = messages.StringField(12)
 
 class SessionFormByConference(messages.Message):
     """Conference key for session form."""
@@ -142,6 +233,7 @@ class SessionFormByConference(messages.Message):
 
 class Speaker(ndb.Model):
     """Speaker object."""
+    _use_memcache = False   # cached by cache.py instead
     speakerName = ndb.StringProperty(required=True)
     speakerInfo = ndb.TextProperty()
     speakerContact = ndb.StringProperty()
@@ -153,7 +245,63 @@ class SpeakerForm(messages.Message):
     speakerContact = messages.StringField(3)
     websafeKey = messages.StringField(4)
 
+class ImportSpeakersForm(messages.Message):
+    """ImportSpeakersForm -- bulk speaker import inbound form message"""
+    speakers = messages.MessageField(SpeakerForm, 1, repeated=True)
+    csv = messages.StringField(2)   # alternative to speakers, header row first
+
+class SearchPosting(ndb.Model):
+    """SearchPosting -- frequency of one term in one indexed document"""
+    term = ndb.StringProperty(required=True)
+    kind = ndb.StringProperty()
+    doc = ndb.KeyProperty(required=True)
+    tf = ndb.IntegerProperty(indexed=False)
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- terms currently indexed for one document"""
+    terms = ndb.StringProperty(repeated=True, indexed=False)
+    frequencies = ndb.IntegerProperty(repeated=True, indexed=False)
+
+class SearchForm(messages.Message):
+    """SearchForm -- keyword search inbound form message"""
+    query = messages.StringField(1, required=True)
+    kinds = messages.StringField(2, repeated=True)
+    pageSize = messages.IntegerField(3)
+    pageToken = messages.StringField(4)
+
+class SearchResultForm(messages.Message):
+    """SearchResultForm -- one keyword search hit"""
+    kind = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+    title = messages.StringField(3)
+    score = messages.IntegerField(4)
+
+class SearchResultForms(messages.Message):
+    """SearchResultForms -- keyword search results outbound form message"""
+    items = messages.MessageField(SearchResultForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
 class SpeakerForms(messages.Message):
     """Speaker multiple outbound form messages."""
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class ScheduleSlotForm(messages.Message):
+    """ScheduleSlotForm -- sessions starting at one time of a day"""
+    startTime = messages.StringField(1)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+
+class ScheduleDayForm(messages.Message):
+    """ScheduleDayForm -- one day of a conference schedule"""
+    date = messages.StringField(1)
+    slots = messages.MessageField(ScheduleSlotForm, 2, repeated=True)
+
+class ScheduleForm(messages.Message):
+    """ScheduleForm -- conference, its sessions by day & time, and its speakers"""
+    conference = messages.MessageField(ConferenceForm, 1)
+    days = messages.MessageField(ScheduleDayForm, 2, repeated=True)
+    speakers = messages.MessageField(SpeakerForm, 3, repeated=True)
+    registered = messages.BooleanField(4)
+    etag = messages.StringField(5)
+    notModified = messages.BooleanField(6)
 
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""notify.py
+
+Email notifications. Senders queue a compact record (kind, recipient and
+template fields) on the 'notifications' pull queue; a worker leases them
+in batches, renders each with its kind's template, sends the batch and
+deletes what went out. Failed sends are retried with exponential backoff
+by extending their lease.
+
+"""
+
+import json
+import logging
+import string
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+
+import dispatch
+from settings import NOTIFICATIONS_MAIL_STUB
+
+QUEUE_NAME = 'notifications'
+WORKER_URL = '/tasks/send_notifications'
+LEASE_SECONDS = 60
+BATCH_SIZE = 100
+TIME_BUDGET = 50        # seconds of leasing per worker run
+BASE_BACKOFF = 30       # seconds; doubled on every retry
+MAX_BACKOFF = 3600
+MAX_RETRIES = 8
+
+TEMPLATES = {
+    'conferenceCreated': (
+        'You created a new Conference!',
+        'Hi, you have created the following conference:\r\n\r\n'
+        '$name\r\n$city\r\n$startDate - $endDate\r\n$topics'),
+    # records forwarded from /tasks/send_confirmation_email tasks queued
+    # before notifications moved to the pull queue; drop after one release
+    'conferenceCreatedLegacy': (
+        'You created a new Conference!',
+        'Hi, you have created a following conference:\r\n\r\n'
+        '$conferenceInfo'),
+    'registered': (
+        'You are registered for $name',
+        'Hi, you are now registered for $name.'),
+    'unregistered': (
+        'Your registration for $name was cancelled',
+        'Hi, you are no longer registered for $name.'),
+}
+
+
+class StubMailer(object):
+    """Mailer that keeps messages in memory instead of sending them.
+
+    Lets the worker be run offline to measure rendering and queue
+    throughput without the mail service.
+    """
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class AppEngineMailer(object):
+    """Mailer that sends through the App Engine mail service."""
+    def send(self, message):
+        message.send()
+
+
+def _sender():
+    return 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+
+
+def queueNotificationAsync(kind, to, transactional=False, **fields):
+    """Start queueing a notification; return the add RPC.
+
+    Call wakeWorker() once the enclosing transaction, if any, commits.
+    """
+    if kind not in TEMPLATES:
+        raise ValueError('Unknown notification kind: %s' % kind)
+    payload = json.dumps({'kind': kind, 'to': to, 'fields': fields})
+    return taskqueue.Queue(QUEUE_NAME).add_async(
+        taskqueue.Task(payload=payload, method='PULL', tag=kind),
+        transactional=transactional)
+
+
+def wakeWorker():
+    """Make sure a worker runs soon to drain the queue."""
+    # one worker run per window drains everything queued meanwhile
+    dispatch.enqueueCoalesced(WORKER_URL, QUEUE_NAME)
+
+
+def queueNotification(kind, to, **fields):
+    """Queue one notification of the given kind for the worker to send."""
+    queueNotificationAsync(kind, to, **fields).get_result()
+    wakeWorker()
+
+
+def render(kind, fields):
+    """Return an EmailMessage for the notification, without a sender."""
+    subject, body = TEMPLATES[kind]
+    return mail.EmailMessage(
+        subject=string.Template(subject).safe_substitute(fields),
+        body=string.Template(body).safe_substitute(fields))
+
+
+def _backoff(task):
+    return min(MAX_BACKOFF, BASE_BACKOFF * 2 ** task.retry_count)
+
+
+def _processBatch(queue, mailer, sender):
+    """Lease, send and settle one batch; return (leased, sent, failed)."""
+    tasks = queue.lease_tasks(LEASE_SECONDS, BATCH_SIZE)
+    done = []
+    sent = failed = 0
+    try:
+        for task in tasks:
+            try:
+                record = json.loads(task.payload)
+                message = render(record['kind'], record['fields'])
+                message.sender = sender
+                message.to = record['to']
+            except (ValueError, KeyError, TypeError, mail.Error):
+                # retrying won't fix a bad record or address
+                logging.error('Dropping malformed notification %s', task.name)
+                done.append(task)
+                continue
+            try:
+                mailer.send(message)
+                sent += 1
+                done.append(task)
+            except Exception:
+                failed += 1
+                if task.retry_count >= MAX_RETRIES:
+                    logging.exception('Giving up on notification %s to %s',
+                                      task.name, record['to'])
+                    done.append(task)
+                else:
+                    logging.warning('Notification %s failed, retry %d',
+                                    task.name, task.retry_count)
+                    queue.modify_task_lease(task, _backoff(task))
+    finally:
+        # whatever went out is never sent again, even if the batch broke off
+        if done:
+            queue.delete_tasks(done)
+    return len(tasks), sent, failed
+
+
+def processQueue(mailer=None):
+    """Drain the notification queue for up to TIME_BUDGET seconds.
+
+    Returns a dict of counts and the send rate, for logging.
+    """
+    if mailer is None:
+        mailer = StubMailer() if NOTIFICATIONS_MAIL_STUB else AppEngineMailer()
+    queue = taskqueue.Queue(QUEUE_NAME)
+    sender = _sender()
+    start = time.time()
+    leased = sent = failed = 0
+    while time.time() - start < TIME_BUDGET:
+        batchLeased, batchSent, batchFailed = _processBatch(
+            queue, mailer, sender)
+        leased += batchLeased
+        sent += batchSent
+        failed += batchFailed
+        if batchLeased < BATCH_SIZE:
+            break
+    elapsed = time.time() - start
+    return {'leased': leased, 'sent': sent, 'failed': failed,
+            'seconds': elapsed, 'perSecond': sent / elapsed if elapsed else 0}
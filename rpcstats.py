@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""rpcstats.py
+
+Per-request RPC instrumentation. apiproxy hooks count every API call
+(datastore, memcache, taskqueue, urlfetch, mail...) made while a request
+is served, with its payload bytes and time in flight. The WSGI
+middleware logs one line per request and folds it into per-endpoint
+counters and histograms, which each instance flushes to memcache every
+FLUSH_INTERVAL seconds, so requests themselves make no extra RPCs.
+
+"""
+
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_RPC_STATS_KEY = "RPC_STATS:%s:%s"
+MEMCACHE_RPC_STATS_INDEX = "RPC_STATS_INDEX"
+FLUSH_INTERVAL = 10     # seconds
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500)   # ms
+RPC_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_local = threading.local()
+_pending = {}           # endpoint -> {counter: delta} not yet flushed
+_pendingLock = threading.Lock()
+_lastFlush = [time.time()]
+
+
+def _preCall(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats['starts'][id(response)] = time.time()
+
+
+def _postCall(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return
+    start = stats['starts'].pop(id(response), None)
+    counts = stats['services'].setdefault(
+        service, {'calls': 0, 'bytes': 0, 'ms': 0.0})
+    counts['calls'] += 1
+    counts['bytes'] += request.ByteSize() + response.ByteSize()
+    if start is not None:
+        counts['ms'] += (time.time() - start) * 1000
+
+
+def install():
+    """Register the apiproxy hooks; later calls do nothing."""
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpcstats', _preCall)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('rpcstats', _postCall)
+
+
+def begin():
+    """Start counting this thread's RPCs; end() returns what was counted."""
+    _local.stats = {'starts': {}, 'services': {}}
+
+
+def end():
+    """Stop counting; return {service: {'calls', 'bytes', 'ms'}} since begin()."""
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    return stats['services'] if stats else {}
+
+
+def _endpointName(environ):
+    path = environ.get('PATH_INFO', '')
+    if path.startswith('/_ah/spi/'):
+        return path[len('/_ah/spi/'):]      # e.g. ConferenceApi.getConference
+    return path
+
+
+def _bucket(bounds, value):
+    for bound in bounds:
+        if value <= bound:
+            return '<=%d' % bound
+    return '>%d' % bounds[-1]
+
+
+def _finishRequest(endpoint, wallMs):
+    """Log the request's RPCs and add them to the pending counters."""
+    services = end()
+    calls = sum(counts['calls'] for counts in services.values())
+    logging.info('rpcstats %s', json.dumps({
+        'endpoint': endpoint, 'wallMs': int(wallMs), 'rpcs': calls,
+        'services': services}, sort_keys=True))
+
+    deltas = {'requests': 1, 'wallMs': int(wallMs), 'rpcs': calls,
+              'latency%s' % _bucket(LATENCY_BUCKETS, wallMs): 1,
+              'rpcCount%s' % _bucket(RPC_COUNT_BUCKETS, calls): 1}
+    for service, counts in services.items():
+        deltas['calls:%s' % service] = counts['calls']
+        deltas['bytes:%s' % service] = counts['bytes']
+        deltas['ms:%s' % service] = int(counts['ms'])
+
+    now = time.time()
+    with _pendingLock:
+        pending = _pending.setdefault(endpoint, {})
+        for counter, delta in deltas.items():
+            pending[counter] = pending.get(counter, 0) + delta
+        batch = None
+        if now - _lastFlush[0] >= FLUSH_INTERVAL:
+            batch = dict(_pending)
+            _pending.clear()
+            _lastFlush[0] = now
+    if batch:
+        _flush(batch)
+
+
+def _flush(batch):
+    """Add an instance's pending counters to the shared ones in memcache."""
+    memcache.offset_multi(
+        dict((MEMCACHE_RPC_STATS_KEY % (endpoint, counter), delta)
+             for endpoint, counters in batch.items()
+             for counter, delta in counters.items()),
+        initial_value=0)
+    # remember which counters exist so getStats knows what to read
+    index = memcache.get(MEMCACHE_RPC_STATS_INDEX) or {}
+    changed = False
+    for endpoint, counters in batch.items():
+        known = set(index.get(endpoint, ()))
+        if not known.issuperset(counters):
+            index[endpoint] = sorted(known.union(counters))
+            changed = True
+    if changed:
+        memcache.set(MEMCACHE_RPC_STATS_INDEX, index)
+
+
+def middleware(app):
+    """Wrap a WSGI app so each of its requests is instrumented."""
+    install()
+
+    def instrumented(environ, start_response):
+        if getattr(_local, 'stats', None) is not None:
+            # counted by an outer begin(), e.g. benchmarks/run.py
+            return app(environ, start_response)
+        begin()
+        start = time.time()
+        try:
+            return app(environ, start_response)
+        finally:
+            _finishRequest(_endpointName(environ), (time.time() - start) * 1000)
+    return instrumented
+
+
+def getStats():
+    """Return {endpoint: {counter: value}} across all instances."""
+    index = memcache.get(MEMCACHE_RPC_STATS_INDEX) or {}
+    keys = dict(((endpoint, counter), MEMCACHE_RPC_STATS_KEY % (endpoint, counter))
+                for endpoint, counters in index.items() for counter in counters)
+    values = memcache.get_multi(keys.values())
+    stats = {}
+    for (endpoint, counter), key in keys.items():
+        stats.setdefault(endpoint, {})[counter] = int(values.get(key, 0))
+    for counters in stats.values():
+        if counters.get('requests'):
+            counters['meanWallMs'] = float(counters['wallMs']) / counters['requests']
+            counters['meanRpcs'] = float(counters['rpcs']) / counters['requests']
+    return stats
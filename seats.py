@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat inventory for conferences. The remaining seat count of a
+conference is spread over NUM_SHARDS root SeatShard entities so that
+concurrent registrations write to different entity groups instead of
+all contending on the Conference entity.
+
+"""
+
+import datetime
+import random
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import cache
+from models import Conference
+from models import SeatReconcile
+from models import SeatShard
+
+NUM_SHARDS = 20
+MEMCACHE_SEATS_KEY = "SEATS:%s"
+SEATS_CACHE_TTL = 60
+RECONCILE_KEY = ndb.Key(SeatReconcile, 'seats')
+# the SeatShard.updated index is eventually consistent; look back this far
+# before the last run so shards written just before it aren't missed
+RECONCILE_OVERLAP = datetime.timedelta(minutes=5)
+
+
+def _shardKeys(confKey):
+    """Return the SeatShard keys for a conference."""
+    wsck = confKey.urlsafe()
+    return [ndb.Key(SeatShard, '%s:%d' % (wsck, i)) for i in range(NUM_SHARDS)]
+
+
+def _split(seats):
+    """Split seats as evenly as possible across NUM_SHARDS."""
+    seats = max(seats or 0, 0)
+    base, extra = divmod(seats, NUM_SHARDS)
+    return [base + (1 if i < extra else 0) for i in range(NUM_SHARDS)]
+
+
+@ndb.tasklet
+def initSeatsAsync(confKey, seats):
+    """Create (or overwrite) the seat shards of a conference."""
+    shards = [SeatShard(key=key, seats=count)
+              for key, count in zip(_shardKeys(confKey), _split(seats))]
+    yield ndb.put_multi_async(shards)
+    yield ndb.get_context().memcache_delete(MEMCACHE_SEATS_KEY % confKey.urlsafe())
+
+
+def initSeats(confKey, seats):
+    """Create (or overwrite) the seat shards of a conference."""
+    initSeatsAsync(confKey, seats).get_result()
+
+
+def _ensureShards(conf):
+    """Lazily create shards for conferences that predate sharding.
+
+    get_or_insert with a deterministic split keeps this idempotent when
+    several requests race to initialize the same conference.
+    """
+    for key, count in zip(_shardKeys(conf.key), _split(conf.seatsAvailable)):
+        SeatShard.get_or_insert(key.id(), seats=count)
+
+
+@ndb.transactional()
+def _takeFromShard(shardKey):
+    """Take one seat from shardKey; return True on success."""
+    shard = shardKey.get()
+    if not shard or shard.seats <= 0:
+        return False
+    shard.seats -= 1
+    shard.put()
+    return True
+
+
+@ndb.transactional()
+def _giveToShard(shardKey):
+    """Return one seat to shardKey, which must exist (see _ensureShards)."""
+    shard = shardKey.get()
+    shard.seats += 1
+    shard.put()
+
+
+def reserveSeat(conf):
+    """Reserve one seat for conf; return False if the conference is full."""
+    keys = _shardKeys(conf.key)
+    try:
+        if _takeFromShard(random.choice(keys)):
+            memcache.decr(MEMCACHE_SEATS_KEY % conf.key.urlsafe())
+            return True
+    except datastore_errors.TransactionFailedError:
+        pass    # too contended to commit; another shard will do
+
+    # the random shard was empty or busy; look at all of them and try
+    # those left
+    shards = ndb.get_multi(keys)
+    if not all(shards):
+        _ensureShards(conf)
+        shards = ndb.get_multi(keys)
+    candidates = [shard.key for shard in shards if shard and shard.seats > 0]
+    random.shuffle(candidates)
+    contended = None
+    for key in candidates:
+        try:
+            if _takeFromShard(key):
+                memcache.decr(MEMCACHE_SEATS_KEY % conf.key.urlsafe())
+                return True
+        except datastore_errors.TransactionFailedError as e:
+            contended = e
+    if contended:
+        # seats may be left; don't report the conference as full
+        raise contended
+    return False
+
+
+def releaseSeat(conf):
+    """Give one seat back to a random shard of conf."""
+    keys = _shardKeys(conf.key)
+    # a conference that predates sharding gets its full split first, or
+    # the one seat given back would become its whole count
+    if not all(ndb.get_multi(keys)):
+        _ensureShards(conf)
+    _giveToShard(random.choice(keys))
+    memcache.incr(MEMCACHE_SEATS_KEY % conf.key.urlsafe())
+
+
+def _sumShards(conf, shards):
+    """Sum shard counts, falling back to the entity for unsharded conferences."""
+    if not any(shards):
+        return conf.seatsAvailable or 0
+    return sum(shard.seats for shard in shards if shard)
+
+
+@ndb.non_transactional
+def getSeatsAvailable(conferences):
+    """Return dict of conference key -> seats available (cached shard sums)."""
+    conferences = [conf for conf in conferences if conf]
+    cacheKeys = dict((MEMCACHE_SEATS_KEY % conf.key.urlsafe(), conf)
+                     for conf in conferences)
+    cached = memcache.get_multi(cacheKeys.keys())
+
+    result = {}
+    misses = []
+    for cacheKey, conf in cacheKeys.items():
+        if cacheKey in cached:
+            result[conf.key] = cached[cacheKey]
+        else:
+            misses.append(conf)
+
+    if misses:
+        # one get_multi for every shard of every missed conference
+        keys = [key for conf in misses for key in _shardKeys(conf.key)]
+        shards = ndb.get_multi(keys)
+        toCache = {}
+        for i, conf in enumerate(misses):
+            total = _sumShards(conf, shards[i * NUM_SHARDS:(i + 1) * NUM_SHARDS])
+            result[conf.key] = total
+            toCache[MEMCACHE_SEATS_KEY % conf.key.urlsafe()] = total
+        memcache.add_multi(toCache, time=SEATS_CACHE_TTL)
+    return result
+
+
+@ndb.transactional()
+def _setSeatsAvailable(confKey, seats):
+    """Set seatsAvailable on the stored conference; return True if it changed.
+
+    The conference is re-read here so edits made since the reconcile read
+    it (name, dates, maxAttendees...) aren't overwritten.
+    """
+    conf = confKey.get()
+    if conf is None or conf.seatsAvailable == seats:
+        return False
+    conf.seatsAvailable = seats
+    conf.put()
+    return True
+
+
+def _writeBack(confs):
+    """Copy shard sums onto confs' seatsAvailable; return how many changed."""
+    keys = [key for conf in confs for key in _shardKeys(conf.key)]
+    shards = ndb.get_multi(keys)
+    changed = []
+    for i, conf in enumerate(confs):
+        confShards = shards[i * NUM_SHARDS:(i + 1) * NUM_SHARDS]
+        if not any(confShards):
+            continue
+        total = _sumShards(conf, confShards)
+        if conf.seatsAvailable != total and _setSeatsAvailable(conf.key, total):
+            changed.append(conf.key)
+    cache.invalidate(*changed)
+    return len(changed)
+
+
+def _reconcileAll(batchSize):
+    """Write back every conference; used when there is no checkpoint yet."""
+    updated = 0
+    cursor = None
+    more = True
+    while more:
+        confs, cursor, more = Conference.query().fetch_page(
+            batchSize, start_cursor=cursor)
+        updated += _writeBack(confs)
+    return updated
+
+
+def _dirtyConferenceKeys(since, batchSize):
+    """Return keys of conferences with a shard written since `since`."""
+    query = SeatShard.query(SeatShard.updated >= since)
+    confKeys = set()
+    cursor = None
+    more = True
+    while more:
+        shardKeys, cursor, more = query.fetch_page(
+            batchSize * NUM_SHARDS, keys_only=True, start_cursor=cursor)
+        # shard ids are '<conference websafe key>:<n>'
+        confKeys.update(ndb.Key(urlsafe=key.id().rsplit(':', 1)[0])
+                        for key in shardKeys)
+    return list(confKeys)
+
+
+def reconcileSeats(batchSize=100):
+    """Write the shard sums back to Conference.seatsAvailable.
+
+    Conference.seatsAvailable is still what the announcement range query
+    and queryConferences filters see, so it is refreshed from the shards
+    periodically instead of on every registration. Only conferences whose
+    shards were written since the last run are read; the first run, with
+    no checkpoint to go on, does them all.
+    """
+    started = datetime.datetime.utcnow()    # auto_now stamps are UTC too
+    checkpoint = RECONCILE_KEY.get()
+    if checkpoint is None:
+        updated = _reconcileAll(batchSize)
+    else:
+        keys = _dirtyConferenceKeys(
+            checkpoint.lastRun - RECONCILE_OVERLAP, batchSize)
+        updated = 0
+        for i in range(0, len(keys), batchSize):
+            confs = [conf for conf in ndb.get_multi(keys[i:i + batchSize])
+                     if conf]
+            updated += _writeBack(confs)
+    SeatReconcile(key=RECONCILE_KEY, lastRun=started).put()
+    return updated
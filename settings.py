@@ -16,3 +16,11 @@ WEB_CLIENT_ID = '631490357075-u2272lopuvprn5l2hj9q7qrqrk7ptnpk.apps.googleuserco
 # ANDROID_CLIENT_ID = 'replace with Android client ID'
 # IOS_CLIENT_ID = 'replace with iOS client ID'
 # ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Set to True to have the notification worker record messages in memory
+# instead of sending them, e.g. to measure its throughput offline.
+NOTIFICATIONS_MAIL_STUB = False
+
+# tokeninfo endpoint used by getUserId's oauth mode; point it at a local
+# stub to exercise token lookups offline.
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""textsearch.py
+
+Keyword search over conferences, sessions and speakers, backed by an
+inverted index kept in datastore. Each (term, document) pair is one
+SearchPosting holding the term's frequency in that document, and each
+document has a SearchDocument listing its terms and their frequencies,
+so reindexing can drop postings for terms that went away and a search
+can score a candidate with a single get. Pure ndb, so it works on the
+local datastore stub as well.
+
+"""
+
+import re
+
+from google.appengine.ext import ndb
+
+from models import SearchDocument
+from models import SearchPosting
+
+# text fields indexed per kind
+INDEXED_FIELDS = {
+    'Conference': ['name', 'description', 'topics'],
+    'Session': ['session_name', 'highlights'],
+    'Speaker': ['speakerName', 'speakerInfo'],
+}
+
+# postings read per datastore round trip while scanning a query term
+POSTING_BATCH_SIZE = 500
+
+STOPWORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by',
+    'for', 'from', 'in', 'is', 'it', 'of', 'on', 'or', 'the', 'to', 'with'])
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return lowercased word tokens of text, without stopwords."""
+    return [token for token in _TOKEN_RE.findall(text.lower())
+            if token not in STOPWORDS]
+
+
+def _termFrequencies(entity):
+    """Return {term: count} over the entity's indexed fields."""
+    counts = {}
+    for field in INDEXED_FIELDS[entity.key.kind()]:
+        value = getattr(entity, field, None)
+        if not value:
+            continue
+        if isinstance(value, list):
+            value = ' '.join(value)
+        for term in tokenize(value):
+            counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+def _postingKey(term, docKey):
+    return ndb.Key(SearchPosting, '%s %s' % (term, docKey.urlsafe()))
+
+
+def _documentKey(docKey):
+    return ndb.Key(SearchDocument, docKey.urlsafe())
+
+
+def indexEntities(entities):
+    """Add or refresh index entries for Conference/Session/Speaker entities."""
+    entities = [entity for entity in entities if entity]
+    if not entities:
+        return
+    docs = ndb.get_multi([_documentKey(entity.key) for entity in entities])
+    toPut = []
+    toDelete = []
+    for entity, doc in zip(entities, docs):
+        frequencies = _termFrequencies(entity)
+        if doc:
+            toDelete.extend(_postingKey(term, entity.key)
+                            for term in doc.terms if term not in frequencies)
+        toPut.extend(SearchPosting(key=_postingKey(term, entity.key),
+                                   term=term, kind=entity.key.kind(),
+                                   doc=entity.key, tf=tf)
+                     for term, tf in frequencies.items())
+        terms = sorted(frequencies)
+        toPut.append(SearchDocument(key=_documentKey(entity.key), terms=terms,
+            frequencies=[frequencies[term] for term in terms]))
+    ndb.delete_multi(toDelete)
+    ndb.put_multi(toPut)
+
+
+def indexEntity(entity):
+    """Add or refresh index entries for one entity."""
+    indexEntities([entity])
+
+
+def _termQuery(term, prefix, kind=None):
+    """Postings for exactly term, or for every term starting with it."""
+    if prefix:
+        query = SearchPosting.query(SearchPosting.term >= term,
+                                    SearchPosting.term < term + u'\ufffd')
+    else:
+        query = SearchPosting.query(SearchPosting.term == term)
+    if kind:
+        query = query.filter(SearchPosting.kind == kind)
+    return query
+
+
+def _scanDocuments(term, prefix, kinds):
+    """Yield the urlsafe keys of every document of the given kinds holding
+    term, a batch of postings at a time."""
+    for kind in kinds or [None]:
+        query = _termQuery(term, prefix, kind)
+        cursor, more = None, True
+        while more:
+            keys, cursor, more = query.fetch_page(
+                POSTING_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+            if keys:
+                yield [key.id().split(' ', 1)[1] for key in keys]
+
+
+def _score(doc, exact, prefix):
+    """Summed frequency of the query terms in doc, or 0 unless it has them all."""
+    frequencies = dict(zip(doc.terms, doc.frequencies))
+    score = 0
+    for term in exact:
+        if term not in frequencies:
+            return 0
+        score += frequencies[term]
+    prefixScore = sum(tf for term, tf in frequencies.items()
+                      if term.startswith(prefix))
+    return score + prefixScore if prefixScore else 0
+
+
+def search(text, kinds=None):
+    """Return [(docKey, score)] matching every term of text, best first.
+
+    The last term is matched as a prefix, for autocomplete. Score is the
+    summed term frequency of the query terms in the document. Postings of
+    one term are scanned in full, and each document found there is
+    checked against the other terms through its SearchDocument, so no
+    match is dropped and the work is bounded by that one term.
+    """
+    terms = tokenize(text)
+    if not terms:
+        return []
+    exact, prefix = terms[:-1], terms[-1]
+    # an exact term never has more postings than a prefix of itself would
+    driver, driverIsPrefix = (exact[0], False) if exact else (prefix, True)
+
+    scores = {}
+    seen = set()
+    for docIds in _scanDocuments(driver, driverIsPrefix, kinds):
+        # a prefix has one posting per matching term of a document
+        docIds = [docId for docId in set(docIds) if docId not in seen]
+        seen.update(docIds)
+        docs = ndb.get_multi([ndb.Key(SearchDocument, docId) for docId in docIds])
+        for docId, doc in zip(docIds, docs):
+            score = _score(doc, exact, prefix) if doc else 0
+            if score:
+                scores[ndb.Key(urlsafe=docId)] = score
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0].urlsafe()))
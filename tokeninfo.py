@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""tokeninfo.py
+
+Bearer token -> Google user ID lookups for getUserId's oauth mode.
+Results are cached per instance (LRU with TTL) and in memcache, keyed
+by a hash of the token so tokens themselves are never stored. Misses
+go to the tokeninfo endpoint through async urlfetch RPCs; concurrent
+lookups of one token on an instance share a single fetch, and a token
+whose lookups keep failing is backed off instead of refetched on
+every request.
+
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+from settings import TOKENINFO_URL
+
+MEMCACHE_TOKEN_KEY = "TOKENINFO:%s"
+CACHE_TTL = 300             # seconds, also capped by the token's expiry
+LOCAL_TTL = 60
+LRU_SIZE = 1000
+ATTEMPT_DEADLINES = (1, 2, 4)   # seconds per urlfetch attempt
+BASE_BACKOFF = 1                # seconds; doubled per failed lookup
+MAX_BACKOFF = 60
+WAIT_TIMEOUT = sum(ATTEMPT_DEADLINES)
+
+
+class LruCache(object):
+    """Thread-safe, size-bounded in-process cache with per-entry TTL."""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the live value for key, or None."""
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or item[1] < time.time():
+                return None
+            self._items[key] = item     # most recently used goes last
+            return item[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, time.time() + ttl)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+class _Pending(object):
+    """A fetch in progress that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.userId = ''
+
+
+_userIds = LruCache(LRU_SIZE)
+_failures = LruCache(LRU_SIZE)      # token hash -> (failures, retryAt)
+_inflight = {}
+_inflightLock = threading.Lock()
+
+
+@ndb.tasklet
+def _fetchTokenInfo(token, tokenType):
+    """Return (userId, ttl) from the tokeninfo endpoint, or None.
+
+    Each attempt gets a longer deadline than the last; nothing sleeps
+    between attempts.
+    """
+    ctx = ndb.get_context()
+    for deadline in ATTEMPT_DEADLINES:
+        try:
+            resp = yield ctx.urlfetch(TOKENINFO_URL % (tokenType, token),
+                                      deadline=deadline)
+        except urlfetch.Error as e:
+            logging.warning('tokeninfo fetch failed: %s', e)
+            continue
+        if resp.status_code == 200:
+            info = json.loads(resp.content)
+            raise ndb.Return((info.get('user_id', ''),
+                              int(info.get('expires_in', CACHE_TTL))))
+        if resp.status_code == 400 and 'invalid_token' in resp.content \
+                and tokenType != 'access_token':
+            tokenType = 'access_token'
+        elif 400 <= resp.status_code < 500:
+            break       # retrying a rejected token won't help
+    raise ndb.Return(None)
+
+
+def _recordFailure(tokenHash):
+    failures = (_failures.get(tokenHash) or (0, 0))[0] + 1
+    backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (failures - 1))
+    _failures.set(tokenHash, (failures, time.time() + backoff), MAX_BACKOFF)
+
+
+def _fetchUserId(token, tokenType, tokenHash):
+    """Fetch and cache the user ID for token; '' if it can't be had."""
+    result = _fetchTokenInfo(token, tokenType).get_result()
+    if result is None:
+        _recordFailure(tokenHash)
+        return ''
+    userId, ttl = result
+    ttl = min(ttl, CACHE_TTL)
+    if ttl > 0:
+        _userIds.set(tokenHash, userId, min(ttl, LOCAL_TTL))
+        memcache.set(MEMCACHE_TOKEN_KEY % tokenHash, userId, time=ttl)
+    return userId
+
+
+def lookupUserId(token, tokenType='id_token'):
+    """Return the Google user ID for a bearer token, or '' if unknown."""
+    tokenHash = hashlib.sha256(token).hexdigest()
+    userId = _userIds.get(tokenHash)
+    if userId is not None:
+        return userId
+    userId = memcache.get(MEMCACHE_TOKEN_KEY % tokenHash)
+    if userId is not None:
+        _userIds.set(tokenHash, userId, LOCAL_TTL)
+        return userId
+
+    failure = _failures.get(tokenHash)
+    if failure and failure[1] > time.time():
+        return ''
+
+    # only the first thread to miss fetches; the rest wait for its answer
+    with _inflightLock:
+        pending = _inflight.get(tokenHash)
+        leader = pending is None
+        if leader:
+            pending = _inflight[tokenHash] = _Pending()
+    if not leader:
+        pending.done.wait(WAIT_TIMEOUT)
+        return pending.userId
+
+    try:
+        pending.userId = _fetchUserId(token, tokenType, tokenHash)
+    finally:
+        with _inflightLock:
+            del _inflight[tokenHash]
+        pending.done.set()
+    return pending.userId
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""warmup.py
+
+Instance warmup, run from /_ah/warmup before a new instance takes user
+traffic. Exercises the ProtoRPC message machinery and primes memcache
+with what the first requests are most likely to read: the announcement,
+the top conferences with their seat counts and featured speakers, the
+speaker list and the query planner's histograms. Each phase is timed;
+reports are logged and kept in memcache per app version so cold-start
+cost can be compared across releases (see /admin/stats).
+
+"""
+
+import inspect
+import json
+import logging
+import os
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import messages
+from protorpc import protojson
+
+import cache
+import confstats
+import models
+import seats
+from conference import ConferenceApi
+from conference import MEMCACHE_ANNOUNCEMENTS_KEY
+from conference import MEMCACHE_FEATURED_SPEAKER_KEY
+from models import Conference
+from models import Speaker
+
+MEMCACHE_WARMUP_KEY = "WARMUP:%s"
+TOP_CONFERENCES = 20
+TOP_SPEAKERS = 100
+
+
+def _messages():
+    """Encode every message class once so its field machinery is built."""
+    for _, cls in inspect.getmembers(models, inspect.isclass):
+        if issubclass(cls, messages.Message):
+            try:
+                protojson.encode_message(cls())
+            except messages.ValidationError:
+                pass    # required fields unset; the descriptors are built
+    ConferenceApi.all_remote_methods()
+
+
+def _announcement():
+    if memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) is None:
+        ConferenceApi._rebuildAnnouncement()
+
+
+def _topConferenceKeys():
+    """Nearly sold out conferences plus the first page by name."""
+    announced = ConferenceApi._announcementKey().get()
+    keys = Conference.query().order(Conference.name).fetch(
+        TOP_CONFERENCES, keys_only=True)
+    if announced:
+        keys += [ndb.Key(urlsafe=wsck) for wsck in announced.conferences]
+    return list(set(keys))
+
+
+def _conferences(state):
+    conferences = [conf for conf in cache.getMulti(_topConferenceKeys()) if conf]
+    seats.getSeatsAvailable(conferences)
+    state['conferences'] = conferences
+
+
+def _featuredSpeakers(state):
+    wscks = [conf.key.urlsafe() for conf in state['conferences']]
+    cached = memcache.get_multi(
+        [MEMCACHE_FEATURED_SPEAKER_KEY % wsck for wsck in wscks])
+    for wsck in wscks:
+        if MEMCACHE_FEATURED_SPEAKER_KEY % wsck not in cached:
+            ConferenceApi._cacheSpeaker(wsck)
+
+
+def _speakers():
+    cache.getMulti(Speaker.query().fetch(TOP_SPEAKERS, keys_only=True))
+
+
+def run(importMs=None):
+    """Run every warmup phase; return [(phase, ms)] in order."""
+    state = {}
+    phases = [
+        ('messages', _messages),
+        ('announcement', _announcement),
+        ('conferences', lambda: _conferences(state)),
+        ('featuredSpeakers', lambda: _featuredSpeakers(state)),
+        ('speakers', _speakers),
+        ('histograms', confstats.loadHistograms),
+    ]
+    report = []
+    if importMs is not None:
+        report.append(('imports', int(importMs)))
+    for name, phase in phases:
+        start = time.time()
+        try:
+            phase()
+        except Exception:
+            # a cold cache is slower, not broken; keep warming the rest
+            logging.exception('Warmup phase %s failed', name)
+        report.append((name, int((time.time() - start) * 1000)))
+
+    version = os.environ.get('CURRENT_VERSION_ID', '')
+    logging.info('warmup %s', json.dumps(
+        {'version': version, 'phases': report,
+         'totalMs': sum(ms for _, ms in report)}))
+    memcache.set(MEMCACHE_WARMUP_KEY % version, report)
+    return report
+
+
+def getReport():
+    """Return the last warmup report for this app version, or None."""
+    return memcache.get(
+        MEMCACHE_WARMUP_KEY % os.environ.get('CURRENT_VERSION_ID', ''))